@@ -1,34 +1,91 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Any, Awaitable, Callable, Literal, Optional
+from collections import OrderedDict, deque
+from types import SimpleNamespace
+import ast
+import asyncio
+import builtins
+import hashlib
 import os
 import re
+import time
+import traceback
+import uuid
 import httpx
 import uvicorn
-from openai import OpenAI
-from contextlib import asynccontextmanager
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 import json
 
+from service_common import ClientDisconnected, Counter, Histogram, cancel_on_disconnect, format_labels
 
-client = None
+
+client = None  # LLMRouter over the model servers, shared by every LLM call
+sandbox_client = None  # httpx.AsyncClient with a keep-alive pool to the sandbox
+
+SANDBOX_SERVICE_URL = os.environ.get("SANDBOX_URL", "http://sandbox:8001")
+SANDBOX_TIMEOUT_SECONDS = float(os.environ.get("SANDBOX_TIMEOUT_SECONDS", "45"))
+SANDBOX_MAX_CONNECTIONS = int(os.environ.get("SANDBOX_MAX_CONNECTIONS", "64"))
+SANDBOX_BUSY_RETRIES = int(os.environ.get("SANDBOX_BUSY_RETRIES", "3"))  # retries after a 429 before giving up
+SANDBOX_BUSY_MAX_WAIT_SECONDS = float(os.environ.get("SANDBOX_BUSY_MAX_WAIT_SECONDS", "5"))  # cap on Retry-After
+PROJECT_FILE_CONCURRENCY = max(1, int(os.environ.get("PROJECT_FILE_CONCURRENCY", "4")))
+QWEN_MODEL = os.environ.get("QWEN_MODEL", "qwen3-coder")
+LLM_MAX_ATTEMPTS = max(1, int(os.environ.get("CODEGEN_LLM_MAX_ATTEMPTS", "3")))  # backends tried per call
+LLM_EJECT_AFTER = max(1, int(os.environ.get("CODEGEN_LLM_EJECT_AFTER", "3")))  # consecutive failures
+LLM_EJECT_SECONDS = float(os.environ.get("CODEGEN_LLM_EJECT_SECONDS", "30"))
+LLM_AFFINITY = os.environ.get("CODEGEN_LLM_AFFINITY", "1") == "1"  # keep one request's calls on one backend
+LLM_AFFINITY_SLACK = int(os.environ.get("CODEGEN_LLM_AFFINITY_SLACK", "4"))  # extra in-flight calls tolerated
+JOB_WORKERS = max(1, int(os.environ.get("CODEGEN_JOB_WORKERS", "4")))
+JOB_QUEUE_SIZE = max(1, int(os.environ.get("CODEGEN_JOB_QUEUE_SIZE", "100")))  # at least 1, or no job could ever be queued
+JOB_TTL_SECONDS = float(os.environ.get("CODEGEN_JOB_TTL_SECONDS", "3600"))  # finished jobs kept this long
+JOB_MAX_RETAINED = int(os.environ.get("CODEGEN_JOB_MAX_RETAINED", "1000"))  # ... and at most this many
+FIX_PROMPT_TOKEN_BUDGET = int(os.environ.get("FIX_PROMPT_TOKEN_BUDGET", "1500"))
+FIX_MODE = os.environ.get("CODEGEN_FIX_MODE", "full")  # "full" regenerates, "diff" asks for edit blocks
+MAX_CANDIDATES = int(os.environ.get("CODEGEN_MAX_CANDIDATES", "8"))
+CACHE_MAX_ENTRIES = int(os.environ.get("CODEGEN_CACHE_MAX_ENTRIES", "1024"))  # 0 disables
+CACHE_TTL_SECONDS = float(os.environ.get("CODEGEN_CACHE_TTL_SECONDS", "3600"))
+CACHE_DIR = os.environ.get("CODEGEN_CACHE_DIR", "")  # optional on-disk store
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global client
-    client = OpenAI(api_key=os.environ["QWEN_API_KEY"], base_url=os.environ["QWEN_BASE_URL"])
+    global client, sandbox_client
+    base_urls = os.environ.get("QWEN_BASE_URLS") or os.environ["QWEN_BASE_URL"]
+    client = LLMRouter(
+        [url.strip() for url in base_urls.split(",") if url.strip()],
+        os.environ["QWEN_API_KEY"],
+        max_attempts=LLM_MAX_ATTEMPTS,
+        eject_after=LLM_EJECT_AFTER,
+        eject_seconds=LLM_EJECT_SECONDS,
+        affinity_slack=LLM_AFFINITY_SLACK,
+    )
+    sandbox_client = httpx.AsyncClient(
+        base_url=SANDBOX_SERVICE_URL,
+        timeout=SANDBOX_TIMEOUT_SECONDS,
+        limits=httpx.Limits(max_connections=SANDBOX_MAX_CONNECTIONS, max_keepalive_connections=SANDBOX_MAX_CONNECTIONS),
+    )
+    jobs.start()
     yield
-    client = None
+    await jobs.stop()
+    await sandbox_client.aclose()
+    await client.close()
+    client = sandbox_client = None
 
 
 app = FastAPI(title="Auto‑fixing Codegen API", lifespan=lifespan)
-SANDBOX_SERVICE_URL = os.environ.get("SANDBOX_URL", "http://sandbox:8001")
 
 
 class CodeRequest(BaseModel):
     prompt: str
     max_tokens: Optional[int] = 200
     max_iterations: Optional[int] = 3
+    candidates: int = Field(1, ge=1, le=MAX_CANDIDATES)  # best-of-N on the first iteration
+    fix_mode: Literal["full", "diff"] = FIX_MODE
+    no_cache: bool = False
+    affinity_key: Optional[str] = None  # requests sharing a key prefer the same model backend
 
 
 class AutoFixResult(BaseModel):
@@ -37,13 +94,454 @@ class AutoFixResult(BaseModel):
     clean_code: str
     raw_response: str
     fixes_applied: list[str]
+    success: bool = False  # the sandbox ran the final code cleanly and it printed something
+    cached: bool = False
+    coalesced: bool = False  # shared the result of an identical request already in flight
+    candidates_used: int = 1  # first-iteration candidates that finished before one was picked
+    sandbox_calls_saved: int = 0  # attempts rejected by the local pre-check instead of the sandbox
+    prompt_tokens: list[int] = []  # per iteration, as reported by the model server (estimated if not)
+    cached_prompt_tokens: list[int] = []  # per iteration, prompt tokens the model server reused from its cache
+    timings: list[dict[str, float]] = []  # per iteration, milliseconds spent in each stage
+    patches_applied: int = 0  # diff-mode retries fixed with edit blocks
+    patch_fallbacks: int = 0  # diff-mode retries that fell back to full regeneration
+
+
+_QUOTED_RE = re.compile(r"""("[^"]*"|'[^']*'|`[^`]*`)""")
+
+
+class PromptCache:
+    """
+    LRU + TTL cache of verified /generate results.
+
+    Each result is stored once, under a normalised key with runs of whitespace
+    outside quoted literals collapsed and the edges trimmed, so reflowed or
+    re-indented copies of a prompt hit too. The entry remembers the exact key it
+    was stored for, to tell exact hits from normalised ones. Case and punctuation
+    are kept: they change what a program must print. With a directory configured,
+    entries are also written to disk, pruned to the same max_entries, and survive
+    restarts.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, directory: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.exact_hits = 0
+        self.normalized_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._entries: OrderedDict[str, tuple[float, str, dict]] = OrderedDict()  # key -> (expires, exact key, result)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        # Odd-numbered pieces are quoted literals and stay byte-for-byte
+        pieces = _QUOTED_RE.split(prompt)
+        pieces[::2] = [re.sub(r"\s+", " ", piece) for piece in pieces[::2]]
+        return "".join(pieces).strip()
+
+    @staticmethod
+    def keys(prompt: str, settings: dict) -> tuple[str, str]:
+        """(exact key, normalised key) for a prompt under the given generation settings."""
+        def key(kind: str, text: str) -> str:
+            material = json.dumps({"kind": kind, "prompt": text, **settings}, sort_keys=True)
+            return hashlib.sha256(material.encode()).hexdigest()
+        return key("exact", prompt), key("normalized", PromptCache.normalize(prompt))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _lookup(self, key: str) -> Optional[tuple[str, dict]]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1:]
+            del self._entries[key]
+        if self.directory:
+            try:
+                with open(self._path(key)) as f:
+                    expires, exact, result = json.load(f)
+                if expires > now:
+                    self._remember(key, expires, exact, result)
+                    self.disk_hits += 1
+                    return exact, result
+                os.unlink(self._path(key))
+            except (OSError, ValueError):
+                pass
+        return None
+
+    def get(self, prompt: str, settings: dict) -> Optional[dict]:
+        exact, normalized = self.keys(prompt, settings)
+        entry = self._lookup(normalized)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored_for, result = entry
+        if stored_for == exact:
+            self.exact_hits += 1
+        else:
+            self.normalized_hits += 1
+        return result
+
+    def put(self, prompt: str, settings: dict, result: dict):
+        exact, key = self.keys(prompt, settings)
+        expires = time.time() + self.ttl
+        self._remember(key, expires, exact, result)
+        if self.directory:
+            try:
+                tmp = self._path(key) + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump([expires, exact, result], f)
+                os.replace(tmp, self._path(key))
+                self._prune_directory()
+            except OSError:
+                pass
+        self.stores += 1
+
+    def _remember(self, key: str, expires: float, exact: str, result: dict):
+        self._entries[key] = (expires, exact, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune_directory(self):
+        """Keep at most max_entries files on disk, dropping the oldest first."""
+        with os.scandir(self.directory) as listing:
+            files = [(entry.stat().st_mtime, entry.path) for entry in listing if entry.name.endswith(".json")]
+        files.sort()
+        for _, path in files[:max(len(files) - self.max_entries, 0)]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        hits = self.exact_hits + self.normalized_hits
+        lookups = hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": hits,
+            "exact_hits": self.exact_hits,
+            "normalized_hits": self.normalized_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "directory": self.directory or None,
+        }
+
+
+prompt_cache = PromptCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS, CACHE_DIR)
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one in-flight task instead of each
+    starting their own. The task is cancelled only once every caller has gone.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._waiters: dict[str, int] = {}
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """Await the shared result for key; also returns whether another caller started it."""
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            task = self._tasks[key] = asyncio.create_task(factory())
+            task.add_done_callback(lambda t: self._tasks.get(key) is t and self._tasks.pop(key))
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task), shared
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                if not task.done():
+                    task.cancel()  # Nobody is waiting for it any more
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._tasks), "leaders": self.leaders, "coalesced": self.coalesced}
+
+
+in_flight = SingleFlight()
+
+
+class CodegenMetrics:
+    """Stage latencies, token counts and auto-fix outcomes, rendered in Prometheus text format on /metrics."""
+
+    def __init__(self):
+        seconds = (0.001, 0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+        self.stages = Histogram("codegen_stage_seconds", "Time per auto-fix stage", seconds, ("stage",))
+        self.generations = Histogram("codegen_generation_seconds", "Auto-fix loop wall-clock time", seconds)
+        self.outcomes = Counter("codegen_generations_total", "Auto-fix loops by outcome", ("outcome",))
+        self.iterations = Counter("codegen_iterations_total", "Auto-fix iterations by the error type they ended with", ("error_type",))
+        self.tokens = Counter("codegen_llm_tokens_total", "Tokens reported by the model servers", ("kind",))
+
+    def record_generation(self, result: "AutoFixResult", seconds: float):
+        self.generations.observe(seconds)
+        if result.success:
+            outcome = "success"
+        elif result.final_answer == "Max iterations reached":
+            outcome = "max_iterations"
+        else:
+            outcome = "unverified"  # accepted without clean stdout
+        self.outcomes.inc(outcome)
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.stages, self.generations, self.outcomes, self.iterations, self.tokens):
+            lines.extend(metric.render())
+        counters = [
+            ("codegen_cache_hits_total", "Requests served from the prompt cache", "", prompt_cache.exact_hits + prompt_cache.normalized_hits),
+            ("codegen_cache_misses_total", "Prompt cache lookups that had to generate", "", prompt_cache.misses),
+            ("codegen_coalesced_total", "Requests that joined an identical one in flight", "", in_flight.coalesced),
+        ]
+        counters += [
+            ("codegen_cancelled_on_disconnect_total", "Requests cancelled because the client hung up", format_labels(("endpoint",), (endpoint,)), count)
+            for endpoint, count in cancelled_on_disconnect.items()
+        ]
+        gauges = [
+            ("codegen_jobs_queued", "Jobs waiting for a worker", "", len(jobs.queue)),
+            ("codegen_jobs_running", "Jobs being worked on", "", sum(job.status == "running" for job in jobs.jobs.values())),
+        ]
+        if client is not None:
+            counters.append(("codegen_llm_retries_total", "Model calls retried on another backend", "", client.retries))
+            gauges += [
+                ("codegen_llm_in_flight", "Model calls in flight per backend", format_labels(("backend",), (b.base_url,)), b.in_flight)
+                for b in client.backends
+            ]
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            declared = set()
+            for name, help, labels, value in series:
+                if name not in declared:
+                    lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                    declared.add(name)
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = CodegenMetrics()
+
+
+@contextmanager
+def stage(spans: dict[str, float], name: str):
+    """Add the block's duration to spans[name] (milliseconds) and the stage histogram, unless it raised."""
+    started = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - started
+    spans[name] = spans.get(name, 0.0) + elapsed * 1000
+    metrics.stages.observe(elapsed, name)
+
+
+# Calls made while this is set prefer the backend that served the same key last,
+# so its prompt cache still holds their shared prefix
+llm_affinity: ContextVar[Optional[str]] = ContextVar("llm_affinity", default=None)
+
+
+def affinity_key(requested: Optional[str] = None) -> Optional[str]:
+    return (requested or uuid.uuid4().hex) if LLM_AFFINITY else None
+
+
+@contextmanager
+def affinity(requested: Optional[str] = None):
+    """Pin the LLM calls made inside the block (and tasks started from it) to one backend."""
+    token = llm_affinity.set(affinity_key(requested))
+    try:
+        yield
+    finally:
+        llm_affinity.reset(token)
+
+
+def prompt_usage(response) -> tuple[Optional[int], int]:
+    """(prompt tokens, of which served from the server's prompt cache) as reported in a completion."""
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None)
+    if cached is None:
+        timings = getattr(response, "timings", None) or {}  # llama.cpp: cache_n reused, prompt_n evaluated
+        cached = timings.get("cache_n") if isinstance(timings, dict) else None
+    return prompt_tokens, cached or 0
+
+
+class LLMBackend:
+    """One OpenAI-compatible model server and its load / health bookkeeping."""
+
+    def __init__(self, base_url: str, client: AsyncOpenAI):
+        self.base_url = base_url
+        self.client = client
+        self.in_flight = 0
+        self.latency = 0.0  # moving average of successful calls, seconds
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def stats(self, now: float) -> dict:
+        return {
+            "base_url": self.base_url,
+            "in_flight": self.in_flight,
+            "latency_ms": round(self.latency * 1000, 1),
+            "requests": self.requests,
+            "failures": self.failures,
+            "healthy": self.available(now),
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_tokens,
+        }
+
+
+class LLMRouter:
+    """
+    Sends each chat completion to the least-loaded healthy backend: fewest calls
+    in flight, then lowest recent latency. Connection errors, 5xx and 429 are
+    retried on another backend; a backend that fails `eject_after` times in a
+    row is skipped for `eject_seconds` and then tried again.
+
+    Calls made under `affinity()` stick to the backend that last served their
+    key, unless it is down or has `affinity_slack` more calls in flight than
+    the least-loaded one. llama.cpp then picks the slot whose cached prompt
+    matches best, so follow-up calls only prefill what is new.
+
+    Exposes `chat.completions.create`, like the AsyncOpenAI client it replaces.
+    """
+
+    LATENCY_DECAY = 0.3
+    MAX_PINS = 4096
+
+    def __init__(self, base_urls: list[str], api_key: str, max_attempts: int = 3,
+                 eject_after: int = 3, eject_seconds: float = 30, affinity_slack: int = 4, **client_options):
+        if not base_urls:
+            raise ValueError("At least one LLM backend is required")
+        self.backends = [
+            # Retries go to the next backend instead of back to the same one
+            LLMBackend(url, AsyncOpenAI(api_key=api_key, base_url=url, max_retries=0, **client_options))
+            for url in base_urls
+        ]
+        self.max_attempts = max_attempts
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.affinity_slack = affinity_slack
+        self.retries = 0
+        self.affinity_hits = 0
+        self._pins: OrderedDict[str, LLMBackend] = OrderedDict()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def pick(self, exclude: tuple[LLMBackend, ...] = (), key: Optional[str] = None) -> LLMBackend:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude] or self.backends
+        healthy = [b for b in candidates if b.available(now)]
+        if not healthy:
+            return min(candidates, key=lambda b: b.ejected_until)  # All ejected: try the one back soonest
+        best = min(healthy, key=lambda b: (b.in_flight, b.latency))
+        pinned = self._pins.get(key) if key else None
+        if pinned in healthy and pinned.in_flight <= best.in_flight + self.affinity_slack:
+            self.affinity_hits += 1
+            return pinned
+        return best
+
+    def _pin(self, key: str, backend: LLMBackend):
+        self._pins[key] = backend
+        self._pins.move_to_end(key)
+        while len(self._pins) > self.MAX_PINS:
+            self._pins.popitem(last=False)
+
+    @staticmethod
+    def _retryable(exc: Exception) -> bool:
+        if isinstance(exc, APIStatusError):
+            return exc.status_code >= 500 or exc.status_code == 429
+        return isinstance(exc, APIConnectionError)
+
+    async def create(self, **kwargs):
+        key = llm_affinity.get()
+        tried: tuple[LLMBackend, ...] = ()
+        for attempt in range(self.max_attempts):
+            backend = self.pick(tried, key)
+            tried += (backend,)
+            if attempt:
+                self.retries += 1
+            backend.in_flight += 1
+            backend.requests += 1
+            started = time.perf_counter()
+            try:
+                response = await backend.client.chat.completions.create(**kwargs)
+            except Exception as e:
+                if not self._retryable(e):
+                    raise  # The request itself is bad; another backend would say the same
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.eject_after:
+                    backend.ejected_until = time.monotonic() + self.eject_seconds
+                if attempt == self.max_attempts - 1:
+                    raise
+                continue
+            finally:
+                backend.in_flight -= 1
+            elapsed = time.perf_counter() - started
+            backend.latency = elapsed if not backend.latency else (
+                self.LATENCY_DECAY * elapsed + (1 - self.LATENCY_DECAY) * backend.latency
+            )
+            backend.consecutive_failures = 0
+            backend.ejected_until = 0.0
+            prompt_tokens, cached_tokens = prompt_usage(response)
+            backend.prompt_tokens += prompt_tokens or 0
+            backend.cached_tokens += cached_tokens
+            metrics.tokens.inc("prompt", amount=prompt_tokens or 0)
+            metrics.tokens.inc("cached_prompt", amount=cached_tokens)
+            metrics.tokens.inc("completion", amount=getattr(getattr(response, "usage", None), "completion_tokens", None) or 0)
+            if key:
+                self._pin(key, backend)
+            return response
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        prompt_tokens = sum(b.prompt_tokens for b in self.backends)
+        cached_tokens = sum(b.cached_tokens for b in self.backends)
+        return {
+            "retries": self.retries,
+            "affinity_hits": self.affinity_hits,
+            "prompt_tokens": prompt_tokens,
+            "prefill_tokens": prompt_tokens - cached_tokens,
+            "cached_prompt_tokens": cached_tokens,
+            "backends": [b.stats(now) for b in self.backends],
+        }
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.client.close()
 
 
 def needs_fix(sandbox_response: dict) -> tuple[bool, str]:
     """Analyze sandbox response and decide if fix needed."""
-    if sandbox_response.get("success") and sandbox_response["stdout"].strip():
-        return False, "Success"
-    
+    if sandbox_response.get("precheck"):
+        return True, sandbox_response["error_type"]
+    if sandbox_response.get("success"):
+        if sandbox_response["stdout"].strip():
+            return False, "Success"
+        return True, "NO_OUTPUT"  # Ran cleanly but printed nothing; the pre-check leaves this to the sandbox
+
     stderr = sandbox_response.get("stderr", "")
     if "timeout" in stderr.lower():
         return True, "TIMEOUT"
@@ -53,79 +551,607 @@ def needs_fix(sandbox_response: dict) -> tuple[bool, str]:
         return True, "NAME_ERROR"
     if "TypeError" in stderr:
         return True, "TYPE_ERROR"
-    if "no output" in sandbox_response.get("stdout", "").lower():
-        return True, "NO_OUTPUT"
-    
-    return False, "OTHER_ERROR"
+    return True, "OTHER_ERROR"
+
+
+def failure_message(sandbox_response: dict, error_type: str) -> str:
+    """What went wrong, for the fix prompt and fixes_applied: stderr, or a note when the run left none."""
+    if sandbox_response.get("stderr"):
+        return sandbox_response["stderr"]
+    if error_type == "NO_OUTPUT":
+        return "NO_OUTPUT: the code ran without errors but printed nothing"
+    return f"{error_type}: exit code {sandbox_response.get('exit_code')}"
+
+
+# Code touching these can define names we cannot see statically
+_DYNAMIC_NAMES = {"globals", "locals", "vars", "exec", "eval", "__import__", "__builtins__", "setattr"}
+# Bound implicitly by the interpreter: module globals, plus what class bodies and methods see
+_IMPLICIT_NAMES = {
+    "__name__", "__file__", "__doc__", "__spec__", "__loader__", "__package__", "__annotations__", "__builtins__",
+    "__class__", "__module__", "__qualname__",
+}
+# PEP 695 type parameters (`def f[T]`, `class Box[T]`, `type Alias[K] = ...`); absent before 3.12
+_TYPE_PARAM_NODES = tuple(getattr(ast, kind) for kind in ("TypeVar", "ParamSpec", "TypeVarTuple") if hasattr(ast, kind))
+# Statements whose bodies are skipped outright: try blocks (often guarding a NameError) and lazy type aliases
+_UNEVALUATED_STMTS = tuple(getattr(ast, kind) for kind in ("Try", "TryStar", "TypeAlias") if hasattr(ast, kind))
+
+
+def _unconditional_loads(tree: ast.Module) -> list[ast.Name]:
+    """
+    Names read by code that runs whenever the module does: top-level statements,
+    class and `with` bodies, and the parts of compound statements evaluated
+    before a branch is taken. Function and lambda bodies, branches, loop bodies,
+    try blocks and short-circuited operands may never run, so they are skipped.
+    """
+    loads: list[ast.Name] = []
+
+    def expr(node: Optional[ast.AST]):
+        if node is None:
+            return
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loads.append(node)
+        elif isinstance(node, ast.Lambda):
+            arguments(node.args)
+        elif isinstance(node, ast.BoolOp):
+            expr(node.values[0])
+        elif isinstance(node, ast.IfExp):
+            expr(node.test)
+        elif isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+            expr(node.generators[0].iter)
+        else:
+            for child in ast.iter_child_nodes(node):
+                expr(child)
+
+    def arguments(args: ast.arguments):
+        for default in args.defaults + args.kw_defaults:
+            expr(default)
+
+    def block(body: list[ast.stmt]):
+        for stmt in body:
+            if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                for decorator in stmt.decorator_list:
+                    expr(decorator)
+                arguments(stmt.args)
+            elif isinstance(stmt, ast.ClassDef):
+                for node in stmt.decorator_list + stmt.bases + [k.value for k in stmt.keywords]:
+                    expr(node)
+                block(stmt.body)
+            elif isinstance(stmt, (ast.If, ast.While)):
+                expr(stmt.test)
+            elif isinstance(stmt, (ast.For, ast.AsyncFor)):
+                expr(stmt.iter)
+            elif isinstance(stmt, (ast.With, ast.AsyncWith)):
+                for item in stmt.items:
+                    expr(item.context_expr)
+                block(stmt.body)
+            elif isinstance(stmt, ast.Match):
+                expr(stmt.subject)
+            elif isinstance(stmt, ast.AnnAssign):
+                expr(stmt.value)  # The annotation may never be evaluated
+            elif isinstance(stmt, ast.stmt) and not isinstance(stmt, _UNEVALUATED_STMTS):
+                expr(stmt)
+
+    block(tree.body)
+    return loads
+
+
+def _undefined_names(tree: ast.Module) -> list[tuple[str, int]]:
+    """
+    Names that certainly raise NameError when the program runs, in line order.
+
+    A name bound anywhere counts as defined everywhere, and only reads that run
+    unconditionally at module level are checked, so a missing name in a function
+    that is never called or behind a version check is not reported.
+    """
+    defined = set(dir(builtins)) | _IMPLICIT_NAMES
+    loads: list[ast.Name] = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loads.append(node)
+            else:
+                defined.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            defined.add(node.name)
+        elif isinstance(node, ast.arg):
+            defined.add(node.arg)
+        elif isinstance(node, _TYPE_PARAM_NODES):
+            defined.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    return []
+                defined.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            defined.update(node.names)
+        elif isinstance(node, (ast.ExceptHandler, ast.MatchAs, ast.MatchStar)) and node.name:
+            defined.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            defined.add(node.rest)
+    if any(n.id in _DYNAMIC_NAMES for n in loads):
+        return []
+    return sorted({(n.id, n.lineno) for n in _unconditional_loads(tree) if n.id not in defined}, key=lambda x: x[1])
+
+
+def precheck(code: str) -> Optional[tuple[str, str]]:
+    """
+    Cheap local checks run before the sandbox: compile and undefined names.
+    Returns (error_type, stderr-style message) for code that cannot be right.
+    Whether it prints anything is left to the sandbox, since output can come
+    from too many places (pprint.pp, logging, sys.stdout, ...) to rule out here.
+    """
+    if not code.strip():
+        return "NO_OUTPUT", "No output: the model returned no code"
+    try:
+        compile(code, "<string>", "exec")
+    except SyntaxError as e:
+        return "SYNTAX_ERROR", "".join(traceback.format_exception_only(type(e), e)).rstrip()
+    except ValueError as e:  # e.g. null bytes in source
+        return "SYNTAX_ERROR", f"SyntaxError: {e}"
+    tree = ast.parse(code)
+    undefined = _undefined_names(tree)
+    if undefined:
+        name, line = undefined[0]
+        return "NAME_ERROR", f"NameError: name {name!r} is not defined (line {line}, found before execution)"
+    return None
+
+
+async def _execute_in_sandbox(code: str) -> dict:
+    """Run code on the sandbox service over the shared keep-alive connection pool."""
+    if sandbox_client is None:
+        raise HTTPException(status_code=503, detail="Service not ready")
+    for attempt in range(SANDBOX_BUSY_RETRIES + 1):
+        sandbox_resp = await sandbox_client.post("/execute", json={"code": code})
+        if sandbox_resp.status_code != 429:
+            return sandbox_resp.json()
+        # Queue full: the code never ran, so wait as asked rather than judge the empty result
+        retry_after = sandbox_resp.headers.get("Retry-After") or sandbox_resp.json().get("retry_after") or 1
+        if attempt < SANDBOX_BUSY_RETRIES:
+            await asyncio.sleep(min(float(retry_after), SANDBOX_BUSY_MAX_WAIT_SECONDS))
+    raise HTTPException(status_code=503, detail="Sandbox is busy", headers={"Retry-After": str(retry_after)})
+
+
+CODEGEN_SYSTEM_PROMPT = """You are a Python code generator. RULES:
+- Output ONLY valid Python code that runs immediately when pasted into Python interpreter
+- NO ``` markdown fences, NO # comments, NO explanations  
+- Include function definition + test call + print(result)
+EVERY response MUST be directly executable Python ONLY."""
+# Appended to the fix prompt in diff mode; the system prompt stays the same so the cached prefix does too
+DIFF_INSTRUCTIONS = """Do NOT send the whole program this time. RULES:
+- Reply ONLY with one or more edit blocks, NO explanations, NO ``` markdown fences
+- Each edit block has this exact format:
+<<<<<<< SEARCH
+lines copied exactly from the current program
+=======
+the replacement lines
+>>>>>>> REPLACE
+- Every SEARCH must match the current program exactly and only once; keep it short
+- The edited program must still print its result"""
+CODEGEN_MAX_TOKENS = 300
+CODEGEN_TEMPERATURES = (0.7, 0.3)  # first attempt, retries
+
+
+def generation_settings(request: CodeRequest) -> dict:
+    """Everything besides the prompt that decides what /generate produces (the cache and single-flight key)."""
+    return {
+        "model": QWEN_MODEL,
+        "system": hashlib.sha256(CODEGEN_SYSTEM_PROMPT.encode()).hexdigest()[:16],
+        "max_tokens": CODEGEN_MAX_TOKENS,
+        "temperatures": CODEGEN_TEMPERATURES,
+        "max_iterations": request.max_iterations,
+        "candidates": request.candidates,
+        "fix_mode": request.fix_mode,
+    }
+
+
+CHARS_PER_TOKEN = 4  # rough average for code and English; good enough for budgeting
+_FRAME_RE = re.compile(r'^(\s*)File "(.+?)", line \d+')
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def compact_stderr(stderr: str) -> str:
+    """
+    Shrink sandbox stderr for a fix prompt: keep traceback frames in the user's
+    code ("<string>") plus the innermost frame, drop library frames in between,
+    and collapse runs of identical lines.
+    """
+    # Group lines into traceback frames (File line + its indented source lines) and plain lines
+    segments: list[tuple[Optional[str], list[str]]] = []
+    lines = stderr.splitlines()
+    i = 0
+    while i < len(lines):
+        match = _FRAME_RE.match(lines[i])
+        if not match:
+            segments.append((None, [lines[i]]))
+            i += 1
+            continue
+        indent, filename = len(match.group(1)), match.group(2)
+        frame = [lines[i]]
+        i += 1
+        while i < len(lines) and not _FRAME_RE.match(lines[i]) and len(lines[i]) - len(lines[i].lstrip()) > indent:
+            frame.append(lines[i])
+            i += 1
+        segments.append((filename, frame))
+
+    kept: list[str] = []
+    dropped = 0
+    for index, (filename, seg_lines) in enumerate(segments):
+        innermost = filename is not None and (index + 1 == len(segments) or segments[index + 1][0] is None)
+        if filename is None or filename == "<string>" or innermost:
+            if dropped:
+                kept.append(f"  ... {dropped} library frame{'s' if dropped > 1 else ''} omitted ...")
+                dropped = 0
+            kept.extend(seg_lines)
+        else:
+            dropped += 1
+
+    compacted: list[str] = []
+    repeats = 0
+    for line in kept:
+        if compacted and line == compacted[-1]:
+            repeats += 1
+            continue
+        if repeats:
+            compacted.append(f"  [previous line repeated {repeats} more times]")
+            repeats = 0
+        compacted.append(line)
+    if repeats:
+        compacted.append(f"  [previous line repeated {repeats} more times]")
+    return "\n".join(compacted)
+
+
+def _keep_tail(text: str, limit: int) -> str:
+    """Last lines of text within limit chars (at least the last line), noting what was cut."""
+    lines = text.splitlines()
+    kept, size = [], 0
+    for line in reversed(lines):
+        if kept and size + len(line) + 1 > limit:
+            break
+        kept.append(line)
+        size += len(line) + 1
+    omitted = len(lines) - len(kept)
+    head = [f"... ({omitted} earlier lines omitted)"] if omitted else []
+    return "\n".join(head + kept[::-1])
+
+
+def _keep_ends(text: str, limit: int) -> str:
+    """First and last lines of text within limit chars, with the middle elided."""
+    lines = text.splitlines()
+    head, tail, size = [], [], 0
+    while len(head) + len(tail) < len(lines):
+        line = lines[len(head)] if len(head) <= len(tail) else lines[-1 - len(tail)]
+        if size + len(line) + 1 > limit:
+            break
+        (head if len(head) <= len(tail) else tail).append(line)
+        size += len(line) + 1
+    omitted = len(lines) - len(head) - len(tail)
+    if not omitted:
+        return text
+    return "\n".join(head + [f"... ({omitted} lines omitted)"] + tail[::-1])
+
+
+def _keep_around(text: str, line_no: int, limit: int) -> str:
+    """Lines around line_no (1-based) within limit chars, widening both ways, noting what was cut."""
+    lines = text.splitlines()
+    if not lines:
+        return text
+    center = min(max(line_no, 1), len(lines)) - 1
+    start, end = center, center + 1
+    size = len(lines[center]) + 1
+    while True:
+        grew = False
+        if end < len(lines) and size + len(lines[end]) + 1 <= limit:
+            size += len(lines[end]) + 1
+            end += 1
+            grew = True
+        if start > 0 and size + len(lines[start - 1]) + 1 <= limit:
+            start -= 1
+            size += len(lines[start]) + 1
+            grew = True
+        if not grew:
+            break
+    kept = lines[start:end]
+    if start:
+        kept.insert(0, f"... ({start} lines omitted)")
+    if end < len(lines):
+        kept.append(f"... ({len(lines) - end} lines omitted)")
+    return "\n".join(kept)
+
+
+def _clip(text: str, limit: int) -> str:
+    """Hard character cap, keeping the start and the end."""
+    if len(text) <= limit:
+        return text
+    marker = f"\n... ({len(text) - limit} chars omitted) ...\n"
+    room = limit - len(marker)
+    if room <= 0:
+        return text[:max(limit, 0)]
+    return text[:room - room // 3] + marker + text[len(text) - room // 3:]
+
+
+_FAILING_LINE_RES = (re.compile(r'File "<string>", line (\d+)'), re.compile(r"\bline (\d+)"))
+
+
+def _failing_line(stderr: str) -> Optional[int]:
+    """The line of the user's code the error points at (innermost frame), if any."""
+    for pattern in _FAILING_LINE_RES:
+        found = pattern.findall(stderr)
+        if found:
+            return int(found[-1])
+    return None
+
+
+def build_fix_prompt(task: str, code: str, stderr: str, error_type: str, budget: int = FIX_PROMPT_TOKEN_BUDGET) -> str:
+    """
+    The retry prompt for a failed attempt, compacted to at most `budget` tokens.
+    stderr is compacted first. If the prompt is still too long, the task is
+    trimmed, then older error lines, then the code down to the lines around the
+    failing one, which are always kept.
+
+    It opens with the task exactly as first sent and keeps the parts that change
+    between iterations last, so the model server can reuse the cached prefix.
+    """
+    def render(task: str, error: str, source: str) -> str:
+        return f"""{task}
+
+Previous code for this task:
+{source}
+
+It failed with error: {error}
+
+ERROR TYPE: {error_type}
+Fix this code to work correctly.
+"""
 
-async def auto_fix_loop(prompt: str, max_iterations: int = 3) -> AutoFixResult:
-    """Main auto‑fix loop."""
+    error = compact_stderr(stderr)
+    fix_prompt = render(task, error, code)
+    if estimate_tokens(fix_prompt) <= budget:
+        return fix_prompt
+    room = (budget - 1) * CHARS_PER_TOKEN - len(render("", "", ""))
+    # The model needs the code and the error more than a long restatement of the task
+    task = _clip(task, max(room - len(code) - len(error), room // 4))
+    room -= len(task)
+    error_room = max(room - len(code), min(len(error), room // 3))
+    error = _clip(_keep_tail(error, error_room), error_room)
+    code_room = max(room - len(error), 0)
+    line = _failing_line(stderr)
+    # Leave room for the "lines omitted" notes the helpers add
+    code = _keep_around(code, line, code_room - 60) if line else _keep_ends(code, code_room - 60)
+    return render(task, error, _clip(code, code_room))
+
+
+_EDIT_BLOCK_RE = re.compile(r"^<{5,9} ?SEARCH\n(.*?)^={5,9}\n(.*?)^>{5,9} ?REPLACE", re.MULTILINE | re.DOTALL)
+
+
+def _hunks_as_edits(diff: str) -> list[tuple[str, str]]:
+    """Turn unified-diff hunks into (search, replace) pairs matched on context, not line numbers."""
+    edits, old, new = [], None, None
+    for line in diff.splitlines():
+        if line.startswith("@@"):
+            if old is not None:
+                edits.append(("\n".join(old), "\n".join(new)))
+            old, new = [], []
+        elif old is None or line.startswith(("---", "+++", "\\")):
+            continue
+        elif line.startswith("-"):
+            old.append(line[1:])
+        elif line.startswith("+"):
+            new.append(line[1:])
+        else:
+            old.append(line[1:])
+            new.append(line[1:])
+    if old is not None:
+        edits.append(("\n".join(old), "\n".join(new)))
+    return edits
+
+
+def apply_edits(code: str, reply: str) -> Optional[str]:
+    """
+    Apply SEARCH/REPLACE edit blocks (or a unified diff) to code. Returns None
+    unless every edit matches exactly once and the result still compiles.
+    """
+    reply = re.sub(r"```(?:diff|python)?", "", reply)
+    edits = [(s.rstrip("\n"), r.rstrip("\n")) for s, r in _EDIT_BLOCK_RE.findall(reply)] or _hunks_as_edits(reply)
+    if not edits:
+        return None
+    for search, replace in edits:
+        if not search.strip() or code.count(search) != 1:
+            return None
+        code = code.replace(search, replace, 1)
+    try:
+        compile(code, "<string>", "exec")
+    except (SyntaxError, ValueError):
+        return None
+    return code
+
+
+def _clean(content: str) -> str:
+    clean_code = re.sub(r'```(?:python)?|```', '', content).strip()
+    return re.sub(r'#.*?(?=\n|$)', '', clean_code, flags=re.MULTILINE).strip()
+
+
+async def _generate(prompt: str, temperature: float) -> tuple[str, int, int]:
+    """One model call; returns the reply, its prompt token count and how many of those were cached."""
+    response = await client.chat.completions.create(
+        model=QWEN_MODEL,
+        messages=[
+            {"role": "system", "content": CODEGEN_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=CODEGEN_MAX_TOKENS,
+        temperature=temperature
+    )
+    prompt_tokens, cached_tokens = prompt_usage(response)
+    return response.choices[0].message.content.strip(), prompt_tokens or estimate_tokens(CODEGEN_SYSTEM_PROMPT + prompt), cached_tokens
+
+
+async def _attempt(prompt: str, temperature: float, spans: Optional[dict[str, float]] = None) -> dict:
+    """One generate -> clean -> execute -> classify round; stage timings are added to `spans`."""
+    spans = {} if spans is None else spans
+    # Step 1: Generate code
+    with stage(spans, "llm_generate"):
+        content, prompt_tokens, cached_tokens = await _generate(prompt, temperature)
+    with stage(spans, "clean"):
+        clean_code = _clean(content)
+    return await _evaluate(content, clean_code, prompt_tokens, cached_tokens, spans)
+
+
+async def _patch_attempt(prompt: str, code: str, temperature: float, spans: dict[str, float]) -> Optional[dict]:
+    """Ask for edit blocks against `code` and evaluate the patched program; None if the patch does not apply."""
+    with stage(spans, "llm_generate"):
+        content, prompt_tokens, cached_tokens = await _generate(f"{prompt}\n{DIFF_INSTRUCTIONS}", temperature)
+    with stage(spans, "clean"):
+        patched = apply_edits(code, content)
+        clean_code = _clean(patched) if patched is not None else None
+    if clean_code is None:
+        return None
+    return await _evaluate(content, clean_code, prompt_tokens, cached_tokens, spans)
+
+
+async def _evaluate(content: str, clean_code: str, prompt_tokens: int, cached_tokens: int, spans: dict[str, float]) -> dict:
+    """Pre-check, execute and classify generated code."""
+    # Step 2: Pre-check locally, and only execute in the sandbox what could pass
+    with stage(spans, "precheck"):
+        problem = precheck(clean_code)
+    if problem is not None:
+        error_type, message = problem
+        sandbox_data = {"success": False, "stdout": "", "stderr": message, "precheck": True, "error_type": error_type}
+    else:
+        with stage(spans, "sandbox_execute"):
+            sandbox_data = await _execute_in_sandbox(clean_code)
+
+    # Step 3: Check if fix needed
+    with stage(spans, "classify"):
+        needs_fix_flag, error_type = needs_fix(sandbox_data)
+    return {
+        "content": content,
+        "code": clean_code,
+        "sandbox": sandbox_data,
+        "needs_fix": needs_fix_flag,
+        "error_type": error_type,
+        "sandbox_skipped": problem is not None,
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "timings": spans,
+    }
+
+
+async def _race_candidates(prompt: str, temperature: float, n: int) -> tuple[dict, list[dict]]:
+    """
+    Run n independent attempts at once and return the first that needs no fix,
+    cancelling the rest. If none passes, return the first one to finish. Also
+    returns every attempt that finished.
+    """
+    tasks = [asyncio.create_task(_attempt(prompt, temperature)) for _ in range(n)]
+    finished: list[dict] = []
+    error: Optional[Exception] = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                attempt = await next_done
+            except Exception as e:
+                error = error or e
+                continue
+            finished.append(attempt)
+            if not attempt["needs_fix"]:
+                return attempt, finished
+    finally:
+        for task in tasks:
+            task.cancel()
+    if not finished:
+        raise error
+    return finished[0], finished
+
+
+async def auto_fix_loop(prompt: str, max_iterations: int = 3, candidates: int = 1, fix_mode: str = "full") -> AutoFixResult:
+    """
+    Main auto‑fix loop. With candidates > 1 the first iteration races that many
+    attempts; with fix_mode "diff" retries edit the previous code instead of
+    regenerating it, falling back to full regeneration when the edit does not apply.
+    """
     history = []
     current_prompt = prompt
+    candidates_used = 1
+    sandbox_calls_saved = 0
+    prompt_tokens = []
+    cached_prompt_tokens = []
+    timings = []
+    patches = {"applied": 0, "fallbacks": 0}
+    started = time.perf_counter()
     
     for iteration in range(max_iterations):
-        # Step 1: Generate code
-        response = client.chat.completions.create(
-            model="qwen3-coder",
-            messages=[
-                {"role": "system", "content": """You are a Python code generator. RULES:
-- Output ONLY valid Python code that runs immediately when pasted into Python interpreter
-- NO ``` markdown fences, NO # comments, NO explanations  
-- Include function definition + test call + print(result)
-EVERY response MUST be directly executable Python ONLY."""},
-                {"role": "user", "content": current_prompt}
-            ],
-            max_tokens=300,
-            temperature=0.3 if iteration > 0 else 0.7  # Lower temp on retries
-        )
-        
-        content = response.choices[0].message.content.strip()
-        clean_code = re.sub(r'```(?:python)?|```', '', content).strip()
-        clean_code = re.sub(r'#.*?(?=\n|$)', '', clean_code, flags=re.MULTILINE).strip()
-        
-        # Step 2: Execute in sandbox
-        async with httpx.AsyncClient(timeout=45.0) as http_client:
-            sandbox_resp = await http_client.post(f"{SANDBOX_SERVICE_URL}/execute", json={"code": clean_code})
-            sandbox_data = sandbox_resp.json()
+        if iteration == 0 and candidates > 1:
+            attempt, finished = await _race_candidates(current_prompt, CODEGEN_TEMPERATURES[0], candidates)
+            candidates_used = len(finished)
+            sandbox_calls_saved += sum(a["sandbox_skipped"] for a in finished)
+        else:
+            temperature = CODEGEN_TEMPERATURES[1] if iteration > 0 else CODEGEN_TEMPERATURES[0]  # Lower temp on retries
+            attempt = None
+            spans: dict[str, float] = {}  # a failed patch's stages count towards the iteration too
+            if iteration > 0 and fix_mode == "diff":
+                attempt = await _patch_attempt(current_prompt, clean_code, temperature, spans)
+                patches["applied" if attempt is not None else "fallbacks"] += 1
+            if attempt is None:
+                attempt = await _attempt(current_prompt, temperature, spans)
+            sandbox_calls_saved += attempt["sandbox_skipped"]
+        content, clean_code, sandbox_data = attempt["content"], attempt["code"], attempt["sandbox"]
+        error_type = attempt["error_type"]
+        prompt_tokens.append(attempt["prompt_tokens"])
+        cached_prompt_tokens.append(attempt["cached_tokens"])
+        timings.append({name: round(ms, 3) for name, ms in attempt["timings"].items()})
+        metrics.iterations.inc(error_type)
         
         history.append({
             "iteration": iteration + 1,
             "code": clean_code,
-            "sandbox": sandbox_data
+            "sandbox": sandbox_data,
+            "error": failure_message(sandbox_data, error_type),
         })
         
-        # Step 3: Check if fix needed
-        needs_fix_flag, error_type = needs_fix(sandbox_data)
-        if not needs_fix_flag:
-            return AutoFixResult(
+        if not attempt["needs_fix"]:
+            result = AutoFixResult(
                 final_answer=sandbox_data["stdout"].strip(),
                 iterations=iteration + 1,
                 clean_code=clean_code,
                 raw_response=content,
-                fixes_applied=[f"Iteration {i+1}: Success" for i in range(iteration + 1)]
+                fixes_applied=[f"Iteration {i+1}: Success" for i in range(iteration + 1)],
+                success=error_type == "Success",
+                candidates_used=candidates_used,
+                sandbox_calls_saved=sandbox_calls_saved,
+                prompt_tokens=prompt_tokens,
+                cached_prompt_tokens=cached_prompt_tokens,
+                timings=timings,
+                patches_applied=patches["applied"],
+                patch_fallbacks=patches["fallbacks"],
             )
+            metrics.record_generation(result, time.perf_counter() - started)
+            return result
         
         # Step 4: Generate fix prompt
-        fix_prompt = f"""Previous code failed with error: {sandbox_data['stderr']}
-
-Original task: {prompt}
-
-Fix this code to work correctly:
-{clean_code}
-
-ERROR TYPE: {error_type}
-"""
-        current_prompt = fix_prompt
+        current_prompt = build_fix_prompt(prompt, clean_code, history[-1]["error"], error_type)
         print(f"🔄 Iteration {iteration + 1}: {error_type}")
     
     # Max iterations reached
-    return AutoFixResult(
+    result = AutoFixResult(
         final_answer="Max iterations reached",
         iterations=max_iterations,
         clean_code=clean_code,
         raw_response=content,
-        fixes_applied=[h["sandbox"]["stderr"] for h in history]
+        fixes_applied=[h["error"] for h in history],
+        candidates_used=candidates_used,
+        sandbox_calls_saved=sandbox_calls_saved,
+        prompt_tokens=prompt_tokens,
+        cached_prompt_tokens=cached_prompt_tokens,
+        timings=timings,
+        patches_applied=patches["applied"],
+        patch_fallbacks=patches["fallbacks"],
     )
+    metrics.record_generation(result, time.perf_counter() - started)
+    return result
 
 class ProjectDesignRequest(BaseModel):
     """High-level request to generate a multi-file project."""
@@ -134,6 +1160,8 @@ class ProjectDesignRequest(BaseModel):
     max_files: int = 20
     max_tokens_per_file: int = 800
     temperature: float = 0.4
+    parallelism: Optional[int] = Field(None, ge=1)  # files generated at once, capped by PROJECT_FILE_CONCURRENCY
+    affinity_key: Optional[str] = None  # requests sharing a key prefer the same model backend
 
 
 class GeneratedFile(BaseModel):
@@ -155,8 +1183,8 @@ async def _call_llm(messages: list[dict], max_tokens: int = 512, temperature: fl
     if client is None:
         raise HTTPException(status_code=503, detail="Service not ready")
 
-    resp = client.chat.completions.create(
-        model="qwen3-coder",
+    resp = await client.chat.completions.create(
+        model=QWEN_MODEL,
         messages=messages,
         max_tokens=max_tokens,
         temperature=temperature,
@@ -251,6 +1279,8 @@ async def generate_file_code(
         "functions": functions,
     }
 
+    # Identical for every file of the project up to the file's own spec, so the
+    # model server only prefills that last part after the first file
     user_msg = {
         "role": "user",
         "content": (
@@ -270,55 +1300,424 @@ async def generate_file_code(
     return clean
 
 
+async def generate_files(request: ProjectDesignRequest, design: dict):
+    """
+    Yield (index, path, code, error) for every designed file as soon as it is ready.
+
+    Files only depend on the design, so up to `parallelism` of them are generated
+    at once. Exactly one of code / error is set. Closing the generator early
+    cancels the files still in flight.
+    """
+    files = design.get("files") or []
+    parallelism = min(request.parallelism or PROJECT_FILE_CONCURRENCY, PROJECT_FILE_CONCURRENCY)
+    slots = asyncio.Semaphore(parallelism)
+
+    async def generate_one(index: int, f: dict) -> tuple[int, str, Optional[str], Optional[str]]:
+        path = f.get("path", "app.py")
+        async with slots:
+            try:
+                code = await generate_file_code(
+                    project_prompt=request.prompt,
+                    design=design,
+                    file_spec=f,
+                    max_tokens=request.max_tokens_per_file,
+                    temperature=request.temperature,
+                )
+                return index, path, code, None
+            except HTTPException as e:
+                return index, path, None, f"{path}: {e.detail}"
+            except Exception as e:
+                return index, path, None, f"{path}: {str(e)}"
+
+    tasks = [asyncio.create_task(generate_one(i, f)) for i, f in enumerate(files)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# What the run that produced a cached result cost; a hit does not run anything
+_NOTHING_RAN = {
+    "candidates_used": 0,
+    "sandbox_calls_saved": 0,
+    "prompt_tokens": [],
+    "cached_prompt_tokens": [],
+    "timings": [],
+    "patches_applied": 0,
+    "patch_fallbacks": 0,
+}
+
+
+async def run_generation(request: CodeRequest) -> AutoFixResult:
+    """
+    Serve /generate from the prompt cache, join an identical request already in
+    flight, or run the auto-fix loop and cache a verified result.
+    """
+    settings = generation_settings(request)
+    use_cache = prompt_cache.enabled and not request.no_cache
+    if use_cache:
+        cached = prompt_cache.get(request.prompt, settings)
+        if cached is not None:
+            return AutoFixResult(**{**cached, **_NOTHING_RAN, "cached": True})
+
+    async def generate() -> AutoFixResult:
+        result = await auto_fix_loop(request.prompt, request.max_iterations, request.candidates, request.fix_mode)
+        if use_cache and result.success:
+            prompt_cache.put(request.prompt, settings, result.model_dump())
+        return result
+
+    with affinity(request.affinity_key):
+        if request.no_cache:
+            return await generate()  # Asked for a fresh generation, so do not share one either
+        key, _ = PromptCache.keys(request.prompt, settings)  # Only byte-identical requests share a run
+        result, shared = await in_flight.run(key, generate)
+    return result.model_copy(update={"coalesced": True}) if shared else result
+
+
+async def run_project_generation(request: ProjectDesignRequest, publish: Optional[Callable[[dict], None]] = None) -> ProjectGenerationResult:
+    """
+    Design the project, then generate its files concurrently. `publish`, if given,
+    receives the same design / file / error events as /generate_project/stream.
+    """
+    with affinity(request.affinity_key):
+        design = await design_project(request)
+        if publish:
+            publish({"type": "design", "design": design})
+        results = []
+        async for index, path, code, error in generate_files(request, design):
+            results.append((index, path, code, error))
+            if publish and error is not None:
+                publish({"type": "error", "index": index, "path": path, "error": error})
+            elif publish:
+                publish({"type": "file", "index": index, "path": path, "code": code})
+    results.sort(key=lambda r: r[0])
+
+    generated_files: list[GeneratedFile] = []
+    errors: list[str] = []
+    for _, path, code, error in results:
+        if error is not None:
+            errors.append(error)
+        else:
+            generated_files.append(GeneratedFile(path=path, code=code))
+
+    return ProjectGenerationResult(
+        files=generated_files,
+        design_json=json.dumps(design, ensure_ascii=False, indent=2),
+        errors=errors,
+    )
+
+
+class Job:
+    """One queued /generate or /generate_project run, with an event log subscribers can follow."""
+
+    def __init__(self, kind: str, request: BaseModel):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.request = request
+        self.status = "queued"  # -> running -> succeeded | failed | cancelled
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.events: list[dict] = []
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def publish(self, event: dict):
+        self.events.append(event)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def set_status(self, status: str, **extra):
+        self.status = status
+        if status == "running":
+            self.started = time.time()
+        elif self.done:
+            self.finished = time.time()
+        self.publish({"type": "status", "status": status, **extra})
+
+    async def follow(self):
+        """Yield every event so far, then new ones as they happen, until the job is done."""
+        seen = 0
+        while True:
+            changed = self._changed
+            while seen < len(self.events):
+                yield self.events[seen]
+                seen += 1
+            if self.done:
+                return
+            await changed.wait()
+
+    def info(self, include_result: bool = True) -> dict:
+        info = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+        }
+        if include_result:
+            info["result"] = self.result
+        return info
+
+
+class JobManager:
+    """
+    Bounded queue of generation jobs served by a fixed pool of workers. A job
+    cancelled while queued leaves the queue at once, freeing its place. Finished
+    jobs stay retrievable for `ttl` seconds, and at most `max_retained` are kept.
+    """
+
+    def __init__(self, workers: int, queue_size: int, ttl: float, max_retained: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.ttl = ttl
+        self.max_retained = max_retained
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.queue: deque[Job] = deque()
+        self.completed = {"succeeded": 0, "failed": 0, "cancelled": 0}
+        self._workers: list[asyncio.Task] = []
+        self._submitted = asyncio.Semaphore(0)  # one release per submit; may outnumber queued jobs after cancels
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        for job in self.jobs.values():
+            if job.task is not None:
+                job.task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def submit(self, kind: str, request: BaseModel) -> Job:
+        self.reap()
+        if len(self.queue) >= self.queue_size:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Job queue is full ({self.queue_size}); retry later",
+                headers={"Retry-After": "10"},
+            )
+        job = Job(kind, request)
+        self.jobs[job.id] = job
+        job.set_status("queued")
+        self.queue.append(job)
+        self._submitted.release()
+        return job
+
+    def get(self, job_id: str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown or expired job: {job_id}")
+        return job
+
+    def cancel(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        if job.status == "queued":
+            self.queue.remove(job)
+            self._finish(job, "cancelled")
+        elif job.task is not None:
+            job.task.cancel()
+        return job
+
+    async def _run(self, job: Job) -> dict:
+        if job.kind == "generate":
+            return (await run_generation(job.request)).model_dump()
+        return (await run_project_generation(job.request, publish=job.publish)).model_dump()
+
+    async def _work(self):
+        while True:
+            await self._submitted.acquire()
+            if not self.queue:
+                continue  # That job was cancelled while queued
+            job = self.queue.popleft()
+            try:
+                job.set_status("running")
+                job.task = asyncio.create_task(self._run(job))
+                await asyncio.wait({job.task})
+                if job.task.cancelled():
+                    self._finish(job, "cancelled")
+                elif job.task.exception() is not None:
+                    e = job.task.exception()
+                    job.error = str(e.detail) if isinstance(e, HTTPException) else f"{type(e).__name__}: {e}"
+                    self._finish(job, "failed", error=job.error)
+                else:
+                    job.result = job.task.result()
+                    self._finish(job, "succeeded", result=job.result)
+            finally:
+                job.task = None
+
+    def _finish(self, job: Job, status: str, **extra):
+        self.completed[status] += 1
+        job.set_status(status, **extra)
+
+    def reap(self):
+        """Forget finished jobs past their TTL, then those that finished longest ago beyond max_retained."""
+        now = time.time()
+        finished = sorted((job for job in self.jobs.values() if job.done), key=lambda job: job.finished)
+        for index, job in enumerate(finished):
+            if now - job.finished > self.ttl or len(finished) - index > self.max_retained:
+                del self.jobs[job.id]
+
+    def stats(self) -> dict:
+        statuses = [job.status for job in self.jobs.values()]
+        return {
+            "workers": self.workers,
+            "queued": statuses.count("queued"),
+            "running": statuses.count("running"),
+            "retained": len(self.jobs),
+            "queue_size": self.queue_size,
+            **self.completed,
+        }
+
+
+jobs = JobManager(JOB_WORKERS, JOB_QUEUE_SIZE, JOB_TTL_SECONDS, JOB_MAX_RETAINED)
+
+# Requests abandoned by their client mid-generation, per endpoint
+cancelled_on_disconnect: dict[str, int] = {"generate": 0, "generate_project": 0, "generate_project_stream": 0}
+
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected(request: Request, exc: ClientDisconnected):
+    return Response(status_code=499)  # nginx's "client closed request"; nobody is left to read it
+
+
+async def unless_disconnected(http_request: Request, work: Awaitable[Any], endpoint: str) -> Any:
+    """
+    Await `work`, but cancel it as soon as the client hangs up (answered with
+    499). Cancellation reaches the pending LLM or sandbox call (closing its
+    connection), the remaining iterations and files, and a shared single-flight
+    run once no other caller is waiting for it.
+    """
+    try:
+        return await cancel_on_disconnect(http_request, work)
+    except ClientDisconnected:
+        cancelled_on_disconnect[endpoint] += 1
+        raise
+
+
 @app.get("/health")
 async def health():
     return {"status": "healthy"}
 
 
 @app.post("/generate", response_model=AutoFixResult)
-async def generate_code(request: CodeRequest):
+async def generate_code(request: CodeRequest, http_request: Request):
     global client
     if client is None:
         raise HTTPException(status_code=503, detail="Service not ready")
 
-    return await auto_fix_loop(request.prompt, request.max_iterations)
+    return await unless_disconnected(http_request, run_generation(request), "generate")
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {**prompt_cache.stats(), "single_flight": in_flight.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats")
+async def stats():
+    return {"cancelled_on_disconnect": cancelled_on_disconnect, "llm": client.stats() if client else None}
 
 
 @app.post("/generate_project", response_model=ProjectGenerationResult)
-async def generate_project(request: ProjectDesignRequest):
+async def generate_project(request: ProjectDesignRequest, http_request: Request):
     """
     Multi-step project generation that works within a 32K context limit:
 
     1) Ask the model to DESIGN the project (list of files) as JSON.
     2) For each file, call the model again with only the project summary + that file's spec.
+       Files are generated concurrently; results keep the design's file order.
     """
-    design = await design_project(request)
-    files = design.get("files") or []
+    return await unless_disconnected(http_request, run_project_generation(request), "generate_project")
 
-    generated_files: list[GeneratedFile] = []
-    errors: list[str] = []
 
-    for f in files:
-        path = f.get("path", "app.py")
+@app.post("/generate_project/stream")
+async def generate_project_stream(request: ProjectDesignRequest, http_request: Request):
+    """
+    Like /generate_project, but answers with NDJSON: one `design` line, then a
+    `file` or `error` line per file in completion order (`index` is the file's
+    position in the design), then a final `done` line.
+    """
+    key = affinity_key(request.affinity_key)  # Shared by the design and every streamed file
+    with affinity(key):
+        design = await unless_disconnected(http_request, design_project(request), "generate_project_stream")
+
+    async def lines():
+        yield json.dumps({"type": "design", "design": design}, ensure_ascii=False) + "\n"
+        files = errors = 0
         try:
-            code = await generate_file_code(
-                project_prompt=request.prompt,
-                design=design,
-                file_spec=f,
-                max_tokens=request.max_tokens_per_file,
-                temperature=request.temperature,
-            )
-            generated_files.append(GeneratedFile(path=path, code=code))
-        except HTTPException as e:
-            errors.append(f"{path}: {e.detail}")
-        except Exception as e:
-            errors.append(f"{path}: {str(e)}")
+            with affinity(key):
+                async for index, path, code, error in generate_files(request, design):
+                    if error is not None:
+                        errors += 1
+                        event = {"type": "error", "index": index, "path": path, "error": error}
+                    else:
+                        files += 1
+                        event = {"type": "file", "index": index, "path": path, "code": code}
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+        except asyncio.CancelledError:
+            # Starlette cancels the response on disconnect; leaving the loop cancels the pending files
+            cancelled_on_disconnect["generate_project_stream"] += 1
+            raise
+        yield json.dumps({"type": "done", "files": files, "errors": errors}) + "\n"
 
-    return ProjectGenerationResult(
-        files=generated_files,
-        design_json=json.dumps(design, ensure_ascii=False, indent=2),
-        errors=errors,
-    )
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs/generate", status_code=202)
+async def submit_generate_job(request: CodeRequest):
+    """Queue a /generate run; poll GET /jobs/{id} or follow GET /jobs/{id}/events."""
+    return jobs.submit("generate", request).info()
+
+
+@app.post("/jobs/generate_project", status_code=202)
+async def submit_project_job(request: ProjectDesignRequest):
+    """Queue a /generate_project run; its events include each file as it is generated."""
+    return jobs.submit("generate_project", request).info()
+
+
+@app.get("/jobs")
+async def list_jobs():
+    jobs.reap()
+    return {**jobs.stats(), "jobs": [job.info(include_result=False) for job in jobs.jobs.values()]}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return jobs.get(job_id).info()
+
+
+@app.get("/jobs/{job_id}/events")
+async def follow_job(job_id: str):
+    """Server-sent events: the job's history so far, then live events until it finishes."""
+    job = jobs.get(job_id)
+
+    async def events():
+        async for event in job.follow():
+            yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = jobs.cancel(job_id)
+    return JSONResponse(status_code=202 if not job.done else 200, content=job.info(include_result=False))
 
 
 if __name__ == "__main__":
@@ -1,78 +1,1454 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Any, Callable, Optional
+from contextlib import aclosing, asynccontextmanager
+from concurrent.futures import Future
+from collections import OrderedDict, deque
+import asyncio
+import base64
+import codecs
+import functools
+import hashlib
+import io
+import itertools
+import json
+import math
+import socket
+import struct
 import subprocess
-import resource
 import signal
+import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import time
 import os
+import uuid
 import sys
 import uvicorn
+import zipfile
 
-app = FastAPI(title="Secure Process Sandbox")
+from service_common import ClientDisconnected, Counter, Histogram, cancel_on_disconnect
 
-class ExecuteRequest(BaseModel):
-    code: str
+ZYGOTE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox-zygote.py")
+POOL_SIZE = max(1, int(os.environ.get("SANDBOX_POOL_SIZE", "2")))
+PRELOAD_MODULES = os.environ.get(
+    "SANDBOX_PRELOAD_MODULES",
+    "collections,itertools,functools,math,re,json,string,random,datetime,typing,"
+    "dataclasses,heapq,bisect,statistics,fractions,decimal,traceback,textwrap",
+)
+MAX_CONCURRENCY = max(1, int(os.environ.get("SANDBOX_MAX_CONCURRENCY", str(os.cpu_count() or 1))))
+MAX_QUEUE = max(0, int(os.environ.get("SANDBOX_MAX_QUEUE", "64")))
+MAX_BATCH_ITEMS = int(os.environ.get("SANDBOX_MAX_BATCH_ITEMS", "100"))
+MAX_BATCH_DEADLINE_SECONDS = float(os.environ.get("SANDBOX_MAX_BATCH_DEADLINE_SECONDS", "120"))
+MAX_STDIN_BYTES = int(os.environ.get("SANDBOX_MAX_STDIN_BYTES", str(1024**2)))
+MAX_TEST_CASES = int(os.environ.get("SANDBOX_MAX_TEST_CASES", "100"))
+CACHE_MAX_BYTES = int(os.environ.get("SANDBOX_CACHE_MAX_MB", "0")) * 1024**2  # off unless configured
+CACHE_TTL_SECONDS = float(os.environ.get("SANDBOX_CACHE_TTL_SECONDS", "300"))
+CACHE_DIR = os.environ.get("SANDBOX_CACHE_DIR", "")  # optional on-disk spill
 
-def sandboxed_exec(code: str):
-    """Execute untrusted code with strict limits"""
-    
-    # Set resource limits BEFORE subprocess
-    resource.setrlimit(resource.RLIMIT_CPU, (2, 2))      # 2 CPU seconds
-    resource.setrlimit(resource.RLIMIT_AS, (128 * 1024**2, 128 * 1024**2))  # 128MB
-    resource.setrlimit(resource.RLIMIT_FSIZE, (1024**2, 1024**2))           # 1MB files
-    resource.setrlimit(resource.RLIMIT_NPROC, (10, 10))                     # 10 processes
-    
-    # Create minimal environment
-    env = {
-        "PYTHONPATH": "",
-        "HOME": "/tmp",
-        "TMPDIR": "/tmp",
-        "PATH": "/usr/local/bin:/usr/bin:/bin"
-    }
-    
-    try:
-        proc = subprocess.Popen(
-            [sys.executable, "-c", code],
+# Applied inside each child right before the code runs; requests may ask for
+# different values, clamped to the server caps below.
+DEFAULT_LIMITS = {
+    "timeout_seconds": 10,                # wall clock, enforced by the server
+    "cpu_seconds": 2,                     # 2 CPU seconds
+    "memory_bytes": 128 * 1024**2,        # 128MB
+    "file_size_bytes": 1024**2,           # 1MB files
+    "max_processes": 10,                  # 10 processes
+    "output_bytes": 1024**2,              # 1MB stdout+stderr, then the child is killed
+}
+LIMIT_CAPS = {
+    "timeout_seconds": float(os.environ.get("SANDBOX_MAX_TIMEOUT_SECONDS", "30")),
+    "cpu_seconds": int(os.environ.get("SANDBOX_MAX_CPU_SECONDS", "10")),
+    "memory_bytes": int(os.environ.get("SANDBOX_MAX_MEMORY_MB", "512")) * 1024**2,
+    "file_size_bytes": int(os.environ.get("SANDBOX_MAX_FILE_SIZE_MB", "16")) * 1024**2,
+    "max_processes": int(os.environ.get("SANDBOX_MAX_PROCESSES", "32")),
+    "output_bytes": int(os.environ.get("SANDBOX_MAX_OUTPUT_KB", "16384")) * 1024,
+}
+# Per stream, only this much of the start and end of the output is kept in memory
+OUTPUT_HEAD_BYTES = int(os.environ.get("SANDBOX_OUTPUT_HEAD_KB", "64")) * 1024
+OUTPUT_TAIL_BYTES = int(os.environ.get("SANDBOX_OUTPUT_TAIL_KB", "64")) * 1024
+
+# Persistent sessions: one interpreter per session, cells run against its globals
+MAX_SESSIONS = int(os.environ.get("SANDBOX_MAX_SESSIONS", "16"))
+SESSION_IDLE_SECONDS = float(os.environ.get("SANDBOX_SESSION_IDLE_SECONDS", "600"))
+SESSION_CPU_SECONDS = int(os.environ.get("SANDBOX_SESSION_CPU_SECONDS", "60"))  # whole session, not per cell
+
+# Project runs: each gets a private workspace directory, in memory when /dev/shm exists
+WORKSPACE_ROOT = os.environ.get("SANDBOX_WORKSPACE_ROOT") or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+MAX_WORKSPACE_BYTES = int(os.environ.get("SANDBOX_MAX_WORKSPACE_MB", "16")) * 1024**2
+MAX_WORKSPACE_FILES = int(os.environ.get("SANDBOX_MAX_WORKSPACE_FILES", "500"))
+WORKSPACE_CHECK_SECONDS = float(os.environ.get("SANDBOX_WORKSPACE_CHECK_SECONDS", "0.1"))  # how often a live run's workspace is measured
+WORKSPACE_MODULES = {  # what a project run may invoke as `python -m <module>`
+    m.strip() for m in os.environ.get("SANDBOX_WORKSPACE_MODULES", "unittest,pytest,doctest").split(",") if m.strip()
+}
+
+# Optional cgroup v2 directory delegated to the sandbox. When usable, each child
+# gets its own sub-cgroup with memory.max / pids.max instead of RLIMIT_AS / RLIMIT_NPROC.
+CGROUP_ROOT = os.environ.get("SANDBOX_CGROUP_ROOT", "")
+CGROUP_CONTROLLERS = ("memory", "pids")
+
+# Create minimal environment
+SANDBOX_ENV = {
+    "PYTHONPATH": "",
+    "HOME": "/tmp",
+    "TMPDIR": "/tmp",
+    "PATH": "/usr/local/bin:/usr/bin:/bin"
+}
+
+_HEADER = struct.Struct(">I")
+
+
+def _resolve(fut: Future, value=None, exc: Optional[Exception] = None):
+    # Waiters may have given up (and cancelled the future) before the zygote replied.
+    if fut.done() or not fut.set_running_or_notify_cancel():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(value)
+
+
+class Execution:
+    """Handle for one child forked by a zygote."""
+
+    def __init__(self, request_id: int):
+        self.id = request_id
+        self.pid: Future = Future()
+        self.exit_code: Future = Future()
+        self.rusage: Optional[dict] = None  # set just before exit_code resolves
+        self.session_ended = False  # a session cell raised SystemExit
+        self.killed = False
+
+    def fail(self, exc: Exception):
+        for fut in (self.pid, self.exit_code):
+            _resolve(fut, exc=exc)
+
+    def kill(self):
+        """SIGKILL the child's whole process group (it is a session leader)."""
+        if not self.pid.done() or self.pid.exception():
+            return
+        self.killed = True
+        try:
+            os.killpg(self.pid.result(), signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class ControlChannel:
+    """
+    Server end of the zygote protocol: framed requests out (with fds attached),
+    JSON events back, resolved onto Execution futures by a reader thread.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._send_lock = threading.Lock()
+        self._pending: dict[int, Execution] = {}
+        self._reader = threading.Thread(target=self._read_events, daemon=True)
+        self._reader.start()
+
+    @property
+    def alive(self) -> bool:
+        return self._reader.is_alive()
+
+    def spawn(self, execution: Execution, request: dict, fds: list[int]):
+        payload = json.dumps({"id": execution.id, **request}).encode()
+        message = _HEADER.pack(len(payload)) + payload
+        self._pending[execution.id] = execution
+        try:
+            with self._send_lock:
+                sent = socket.send_fds(self.sock, [message], fds)
+                if sent < len(message):
+                    self.sock.sendall(message[sent:])
+        except OSError as e:
+            self._pending.pop(execution.id, None)
+            raise RuntimeError(f"{type(self).__name__.lower()} unavailable: {e}") from e
+
+    def _read_events(self):
+        try:
+            with self.sock.makefile("rb") as events:
+                for line in events:
+                    event = json.loads(line)
+                    execution = self._pending.get(event["id"])
+                    if execution is None:
+                        continue
+                    if "error" in event:
+                        self._pending.pop(event["id"], None)
+                        execution.fail(RuntimeError(event["error"]))
+                    elif "pid" in event:
+                        _resolve(execution.pid, event["pid"])
+                    elif "exit_code" in event:
+                        self._pending.pop(event["id"], None)
+                        execution.rusage = event.get("rusage")
+                        execution.session_ended = event.get("session_ended", False)
+                        _resolve(execution.exit_code, event["exit_code"])
+        except OSError:
+            pass  # Reset by a peer that died with requests unread
+        # Peer is gone: nothing pending will ever complete.
+        for execution in list(self._pending.values()):
+            execution.fail(RuntimeError(f"{type(self).__name__.lower()} exited"))
+        self._pending.clear()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Zygote(ControlChannel):
+    """One warm interpreter (sandbox-zygote.py) that forks a child per execution."""
+
+    def __init__(self, preload: str):
+        sock, theirs = socket.socketpair()
+        self.proc = subprocess.Popen(
+            [sys.executable, ZYGOTE_PATH, str(theirs.fileno()), preload],
+            pass_fds=[theirs.fileno()],
             stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
             cwd="/tmp",
-            env=env,
-            preexec_fn=os.setsid  # Session leader for killpg
+            env=SANDBOX_ENV,
         )
-        
-        stdout, stderr = proc.communicate(timeout=10)
-        
+        theirs.close()
+        super().__init__(sock)
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.poll() is None and super().alive
+
+    def close(self):
+        super().close()
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+class ZygotePool:
+    """Fixed-size pool of zygotes; dead ones are replaced on the next dispatch."""
+
+    def __init__(self, size: int, preload: str):
+        self.size = size
+        self.preload = preload
+        self.cgroup_root: Optional[str] = None
+        self._zygotes: list[Zygote] = []
+        self._ids = itertools.count(1)
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._zygotes = [Zygote(self.preload) for _ in range(self.size)]
+
+    def _pick(self) -> Zygote:
+        with self._lock:
+            slot = next(self._next) % self.size
+            zygote = self._zygotes[slot]
+            if not zygote.alive:
+                zygote.close()
+                zygote = self._zygotes[slot] = Zygote(self.preload)
+            return zygote
+
+    def spawn(self, code: Optional[str], limits: dict, fds: list[int], mode: str = "exec", cwd: str = "/tmp", **options) -> Execution:
+        execution = Execution(next(self._ids))
+        request = {"code": code, "limits": limits, "cwd": cwd, "cgroup": self.cgroup_root, "mode": mode, **options}
+        self._pick().spawn(execution, request, fds)
+        return execution
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def close(self):
+        with self._lock:
+            for zygote in self._zygotes:
+                zygote.close()
+            self._zygotes = []
+
+
+def _fork_interpreter(code: Optional[str], limits: dict, mode: str) -> tuple[Execution, socket.socket]:
+    """Fork a long-lived interpreter from a zygote; returns it and our end of its control socket."""
+    sock, theirs = socket.socketpair()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        # Its own stdio goes nowhere; fd 3 is the interpreter's control socket
+        process = pool.spawn(code, _child_limits(limits), [devnull, devnull, devnull, theirs.fileno()], mode=mode)
+    except Exception:
+        sock.close()
+        raise
+    finally:
+        os.close(devnull)
+        theirs.close()
+    return process, sock
+
+
+class Session(ControlChannel):
+    """A persistent interpreter forked from a zygote; cells share its globals."""
+
+    def __init__(self, session_id: str, limits: dict):
+        self.process, sock = _fork_interpreter(None, limits, "session")
+        super().__init__(sock)
+        self.id = session_id
+        self.limits = limits
+        self.created = self.last_used = time.monotonic()
+        self.cells = 0
+        self.closed = False
+        self.lock = asyncio.Lock()  # one cell at a time
+        self._cell_ids = itertools.count(1)
+
+    @property
+    def alive(self) -> bool:
+        return not self.closed and super().alive and not self.process.exit_code.done()
+
+    def spawn_cell(self, code: str, fds: list[int]) -> Execution:
+        execution = Execution(next(self._cell_ids))
+        self.spawn(execution, {"code": code}, fds)
+        return execution
+
+    async def run_cell(self, code: str, stdin_data: Optional[str]) -> dict:
+        """Run one cell. A cell that times out, blows its output budget or exits ends the session."""
+        cell = None
+
+        def spawn(fds: list[int]) -> Execution:
+            nonlocal cell
+            cell = self.spawn_cell(code, fds)
+            return cell
+
+        try:
+            result = await run_to_completion(spawn, self.limits, stdin_data)
+        finally:
+            self.cells += 1
+            self.last_used = time.monotonic()
+            if cell is None or cell.killed or cell.session_ended or not self.alive:
+                self.close()
+        return result
+
+    def info(self) -> dict:
+        now = time.monotonic()
         return {
-            "success": proc.returncode == 0,
-            "stdout": stdout.decode('utf-8', errors='ignore').strip(),
-            "stderr": stderr.decode('utf-8', errors='ignore').strip(),
-            "exit_code": proc.returncode
+            "session_id": self.id,
+            "cells": self.cells,
+            "age_seconds": round(now - self.created, 1),
+            "idle_seconds": round(now - self.last_used, 1),
+            "alive": self.alive,
         }
-        
-    except subprocess.TimeoutExpired:
-        os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.process.kill()
+        super().close()
+
+
+class SessionManager:
+    """Owns live sessions: global cap, lookup, and idle-timeout eviction."""
+
+    def __init__(self, max_sessions: int, idle_seconds: float):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.sessions: dict[str, Session] = {}
+        self.evicted = 0
+
+    def create(self, limits: dict) -> Session:
+        self.reap()
+        if len(self.sessions) >= self.max_sessions:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Session limit reached ({self.max_sessions}); close a session and retry",
+                headers={"Retry-After": "5"},
+            )
+        session = Session(uuid.uuid4().hex, limits)
+        self.sessions[session.id] = session
+        return session
+
+    def get(self, session_id: str) -> Session:
+        session = self.sessions.get(session_id)
+        if session is None or not session.alive:
+            self.close(session_id)
+            raise HTTPException(status_code=404, detail=f"Unknown or closed session: {session_id}")
+        return session
+
+    def close(self, session_id: str) -> bool:
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def reap(self):
+        """Close sessions that died or sat idle (and unlocked) past the idle timeout."""
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            idle = now - session.last_used > self.idle_seconds and not session.lock.locked()
+            if idle or not session.alive:
+                self.evicted += 1
+                self.close(session.id)
+
+    async def run_evictions(self):
+        while True:
+            await asyncio.sleep(max(1.0, min(30.0, self.idle_seconds / 4)))
+            self.reap()
+
+    def close_all(self):
+        for session_id in list(self.sessions):
+            self.close(session_id)
+
+
+class CaseRunner(ControlChannel):
+    """Holds one compiled program and forks a fresh child from it for every test case."""
+
+    def __init__(self, code: str, limits: dict):
+        self.process, sock = _fork_interpreter(code, limits, "runner")
+        super().__init__(sock)
+        self._case_ids = itertools.count(1)
+
+    def spawn_case(self, args: list[str], fds: list[int]) -> Execution:
+        execution = Execution(next(self._case_ids))
+        self.spawn(execution, {"args": args}, fds)
+        return execution
+
+    def close(self):
+        self.process.kill()
+        super().close()
+
+
+class WorkspaceError(ValueError):
+    """The submitted project cannot be unpacked (bad path, too large, unreadable archive)."""
+
+
+class Workspace:
+    """
+    A private directory for one project run. Files are written only after their
+    paths and total size check out, the run is held to the same caps by `guard`,
+    and the whole tree is removed on close.
+    """
+
+    def __init__(self, root: str, max_bytes: int, max_files: int):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.bytes = 0
+        self.files = 0
+        self.overflow: Optional[str] = None  # why guard() killed the run
+        self.path = tempfile.mkdtemp(prefix="sandbox-ws-", dir=root)
+
+    @staticmethod
+    def relative(name: str) -> str:
+        """Normalise a project path; anything absolute or escaping the workspace is refused."""
+        parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+        if not parts or name.startswith(("/", "\\")) or ".." in parts:
+            raise WorkspaceError(f"Invalid path in project: {name!r}")
+        return "/".join(parts)
+
+    def add(self, name: str, data: bytes):
+        self.files += 1
+        self.bytes += len(data)
+        if self.files > self.max_files:
+            raise WorkspaceError(f"Project has more than {self.max_files} files")
+        if self.bytes > self.max_bytes:
+            raise WorkspaceError(f"Project exceeds {self.max_bytes} bytes")
+        target = os.path.join(self.path, self.relative(name))
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "xb") as f:
+                f.write(data)
+        except (FileExistsError, NotADirectoryError, IsADirectoryError):
+            # Same file twice, or a file where another entry needs a directory (or vice versa)
+            raise WorkspaceError(f"Duplicate or conflicting path in project: {name!r}") from None
+
+    def add_archive(self, blob: bytes):
+        """Unpack a .zip or .tar(.gz/.bz2/.xz); regular files only, links are refused."""
+        try:
+            if zipfile.is_zipfile(io.BytesIO(blob)):
+                with zipfile.ZipFile(io.BytesIO(blob)) as archive:
+                    for info in archive.infolist():
+                        if stat.S_ISLNK(info.external_attr >> 16):
+                            raise WorkspaceError(f"Unsupported archive entry (link): {info.filename!r}")
+                        if not info.is_dir():
+                            self._check_declared(info.file_size)
+                            self.add(info.filename, archive.read(info))
+                return
+            with tarfile.open(fileobj=io.BytesIO(blob), mode="r:*") as archive:
+                for member in archive:
+                    if member.isdir():
+                        continue
+                    if not member.isfile():
+                        raise WorkspaceError(f"Unsupported archive entry (link or device): {member.name!r}")
+                    self._check_declared(member.size)
+                    self.add(member.name, archive.extractfile(member).read())
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+            raise WorkspaceError(f"Unreadable project archive: {e}") from e
+        except OSError as e:
+            # strerror leaves out the filename, which would reveal the workspace location
+            raise WorkspaceError(f"Unreadable project archive: {e.strerror or e}") from e
+
+    def _check_declared(self, size: int):
+        # Refuse before decompressing anything that would not fit anyway
+        if self.bytes + size > self.max_bytes:
+            raise WorkspaceError(f"Project exceeds {self.max_bytes} bytes")
+
+    def usage(self) -> tuple[int, int]:
+        """(entries, bytes) under the workspace right now, counting what the run has written."""
+        entries = size = 0
+        pending = [self.path]
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as listing:
+                    for entry in listing:
+                        entries += 1
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        else:
+                            size += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue  # Removed while we looked
+        return entries, size
+
+    def guard(self, kill: Callable[[], None], interval: float) -> asyncio.Task:
+        """
+        Start measuring the tree while a run is alive; the run is killed once it
+        holds more than max_bytes, or more entries than max_files plus the
+        project's own directories, so it cannot fill the filesystem that every
+        workspace shares. Call before the run starts; cancel the task after.
+        """
+        entries, _ = self.usage()
+        max_entries = self.max_files + max(entries - self.files, 0)
+
+        async def watch():
+            while True:
+                await asyncio.sleep(interval)
+                entries, size = await asyncio.to_thread(self.usage)
+                if size > self.max_bytes:
+                    self.overflow = f"Workspace limit exceeded ({self.max_bytes} bytes); process killed"
+                elif entries > max_entries:
+                    self.overflow = f"Workspace limit exceeded ({max_entries} files and directories); process killed"
+                else:
+                    continue
+                kill()
+                return
+
+        return asyncio.create_task(watch())
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class SandboxMetrics:
+    """Aggregate execution metrics, rendered in Prometheus text format on /metrics."""
+
+    def __init__(self):
+        seconds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+        self.executions = Counter("sandbox_executions_total", "Executions by outcome", ("status",))
+        self.truncated = Counter("sandbox_output_truncated_total", "Executions whose output was cut")
+        self.wall = Histogram("sandbox_execution_wall_seconds", "Child wall-clock time", seconds)
+        self.cpu = Histogram("sandbox_execution_cpu_seconds", "Child user+sys CPU time", seconds)
+        self.rss = Histogram(
+            "sandbox_execution_max_rss_bytes", "Child peak resident set size",
+            tuple(mb * 1024**2 for mb in (8, 16, 32, 64, 128, 256, 512)),
+        )
+        self.queue_wait = Histogram("sandbox_queue_wait_seconds", "Time spent waiting for an execution slot", seconds)
+        self.disconnects = Counter("sandbox_client_disconnects_total", "Executions abandoned because the client hung up")
+
+    def record(self, result: dict):
+        self.executions.inc(_execution_status(result))
+        if result.get("truncated"):
+            self.truncated.inc()
+        usage = result.get("usage") or {}
+        if "wall_ms" in usage:
+            self.wall.observe(usage["wall_ms"] / 1000)
+        if "cpu_user_ms" in usage:
+            self.cpu.observe((usage["cpu_user_ms"] + usage["cpu_sys_ms"]) / 1000)
+            self.rss.observe(usage["max_rss_kb"] * 1024)
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.executions, self.truncated, self.wall, self.cpu, self.rss, self.queue_wait, self.disconnects):
+            lines.extend(metric.render())
+        for name, help, value in (
+            ("sandbox_running", "Executions currently holding a slot", engine.running),
+            ("sandbox_queued", "Requests waiting for a slot", engine.waiting),
+            ("sandbox_concurrency", "Configured execution slots", engine.concurrency),
+            ("sandbox_pool_size", "Configured zygote count", pool.size),
+            ("sandbox_cache_bytes", "Bytes held by the in-memory result cache", cache.bytes),
+            ("sandbox_sessions", "Live persistent sessions", len(sessions.sessions)),
+        ):
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"]
+        for name, help, value in (
+            ("sandbox_cache_hits_total", "Executions served from the result cache", cache.hits),
+            ("sandbox_cache_misses_total", "Cache lookups that had to execute", cache.misses),
+        ):
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} counter", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def _execution_status(result: dict) -> str:
+    if result["success"]:
+        return "success"
+    return {408: "timeout", 429: "rejected", 500: "error"}.get(result["exit_code"], "failed")
+
+
+metrics = SandboxMetrics()
+
+
+class QueueFull(Exception):
+    """Raised when every execution slot is busy and the wait queue is at capacity."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Sandbox busy: execution queue is full")
+        self.retry_after = retry_after
+
+
+class ExecutionEngine:
+    """Caps concurrent executions and bounds how many requests may wait for a slot."""
+
+    def __init__(self, concurrency: int, max_queue: int):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._avg_seconds = 0.1  # EWMA of slot hold time, used for retry_after
+
+    def retry_after(self) -> int:
+        backlog = (self.waiting + self.running) / self.concurrency
+        return max(1, math.ceil(backlog * self._avg_seconds))
+
+    def full(self) -> bool:
+        return self._slots.locked() and self.waiting >= self.max_queue
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold an execution slot; yields the seconds spent waiting for it."""
+        if self.full():
+            raise QueueFull(self.retry_after())
+        loop = asyncio.get_running_loop()
+        queued = loop.time()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        started = loop.time()
+        queue_seconds = started - queued
+        metrics.queue_wait.observe(queue_seconds)
+        try:
+            yield queue_seconds
+        finally:
+            elapsed = asyncio.get_running_loop().time() - started
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * elapsed
+            self.running -= 1
+            self._slots.release()
+
+
+class ResultCache:
+    """
+    Content-addressed LRU + TTL cache of execution results.
+
+    Memory use is bounded by the JSON size of the stored results. With a spill
+    directory, entries evicted from memory (or too large to keep there) are
+    written to disk and promoted back on the next hit until their TTL expires.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, spill_dir: str = ""):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(code: str, stdin: Optional[str], limits: dict) -> str:
+        material = json.dumps({"code": code, "stdin": stdin, "limits": limits}, sort_keys=True)
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, blob = entry
+            if expires > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(blob)
+            self._drop(key)
+        if self.spill_dir:
+            try:
+                with open(self._spill_path(key), "rb") as f:
+                    expires, blob = json.loads(f.read())
+                if expires > now:
+                    self._store(key, expires, blob.encode(), spill=False)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return json.loads(blob)
+                os.unlink(self._spill_path(key))
+            except (OSError, ValueError):
+                pass
+        self.misses += 1
+        return None
+
+    def put(self, key: str, result: dict):
+        blob = json.dumps(result).encode()
+        self._store(key, time.time() + self.ttl, blob, spill=True)
+
+    def _store(self, key: str, expires: float, blob: bytes, spill: bool):
+        self._drop(key)
+        if len(blob) > self.max_bytes // 8:
+            # Too large to keep in memory without crowding everything else out
+            if spill:
+                self._spill(key, expires, blob)
+            return
+        self._entries[key] = (expires, blob)
+        self.bytes += len(blob)
+        while self.bytes > self.max_bytes:
+            old_key, (old_expires, old_blob) = self._entries.popitem(last=False)
+            self.bytes -= len(old_blob)
+            self.evictions += 1
+            if old_expires > time.time():
+                self._spill(old_key, old_expires, old_blob)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[1])
+
+    def _spill(self, key: str, expires: float, blob: bytes):
+        if not self.spill_dir:
+            return
+        try:
+            tmp = self._spill_path(key) + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump([expires, blob.decode()], f)
+            os.replace(tmp, self._spill_path(key))
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "ttl_seconds": self.ttl,
+            "spill_dir": self.spill_dir or None,
+        }
+
+
+def _init_cgroup_root(path: str) -> Optional[str]:
+    """Enable the controllers we need under a delegated cgroup v2 directory, if usable."""
+    if not path:
+        return None
+    try:
+        with open(os.path.join(path, "cgroup.controllers")) as f:
+            available = f.read().split()
+        missing = [c for c in CGROUP_CONTROLLERS if c not in available]
+        if missing:
+            raise OSError(f"controllers not delegated: {', '.join(missing)}")
+        with open(os.path.join(path, "cgroup.subtree_control"), "w") as f:
+            f.write(" ".join(f"+{c}" for c in CGROUP_CONTROLLERS))
+        return path
+    except OSError as e:
+        print(f"⚠️ cgroup v2 limits disabled ({path}): {e}")
+        return None
+
+
+pool = ZygotePool(POOL_SIZE, PRELOAD_MODULES)
+engine = ExecutionEngine(MAX_CONCURRENCY, MAX_QUEUE)
+cache = ResultCache(CACHE_MAX_BYTES, CACHE_TTL_SECONDS, CACHE_DIR)
+sessions = SessionManager(MAX_SESSIONS, SESSION_IDLE_SECONDS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    pool.cgroup_root = _init_cgroup_root(CGROUP_ROOT)
+    pool.start()
+    evictions = asyncio.create_task(sessions.run_evictions())
+    yield
+    evictions.cancel()
+    sessions.close_all()
+    pool.close()
+
+
+app = FastAPI(title="Secure Process Sandbox", lifespan=lifespan)
+
+class ExecutionLimits(BaseModel):
+    """Per-request limits; anything omitted uses the default, anything larger is capped."""
+
+    timeout_seconds: Optional[float] = Field(None, gt=0)
+    cpu_seconds: Optional[int] = Field(None, gt=0)
+    memory_mb: Optional[int] = Field(None, gt=0)
+    file_size_mb: Optional[int] = Field(None, gt=0)
+    max_processes: Optional[int] = Field(None, gt=0)
+    max_output_kb: Optional[int] = Field(None, gt=0)
+
+
+class ExecuteRequest(BaseModel):
+    code: str
+    stdin: Optional[str] = Field(None, max_length=MAX_STDIN_BYTES)
+    limits: Optional[ExecutionLimits] = None
+    no_cache: bool = False
+
+
+class BatchItem(ExecuteRequest):
+    pass
+
+
+class SessionCreateRequest(BaseModel):
+    # timeout_seconds and max_output_kb apply per cell; cpu_seconds to the whole session
+    limits: Optional[ExecutionLimits] = None
+
+
+class CellRequest(BaseModel):
+    code: str
+    stdin: Optional[str] = Field(None, max_length=MAX_STDIN_BYTES)
+
+
+class BatchRequest(BaseModel):
+    items: list[BatchItem] = Field(..., min_length=1, max_length=MAX_BATCH_ITEMS)
+    deadline_seconds: Optional[float] = Field(None, gt=0)
+
+
+class ProjectFile(BaseModel):
+    path: str  # relative to the workspace root
+    code: str  # same shape as the codegen service's /generate_project files
+
+
+class ProjectRunRequest(BaseModel):
+    """Files and/or an archive (base64 .zip or .tar[.gz]) plus what to run in them."""
+
+    files: list[ProjectFile] = Field([], max_length=MAX_WORKSPACE_FILES)
+    archive: Optional[str] = Field(None, max_length=MAX_WORKSPACE_BYTES * 2)
+    entry_point: Optional[str] = None  # file to run, like `python <entry_point> <args>`
+    module: Optional[str] = None  # allowlisted module to run instead, like `python -m unittest`
+    args: list[str] = []
+    stdin: Optional[str] = Field(None, max_length=MAX_STDIN_BYTES)
+    limits: Optional[ExecutionLimits] = None
+
+
+class TestCase(BaseModel):
+    stdin: Optional[str] = Field(None, max_length=MAX_STDIN_BYTES)
+    args: list[str] = []
+    expected_stdout: Optional[str] = None  # None: the case passes if it exits 0
+    timeout_seconds: Optional[float] = Field(None, gt=0)
+
+
+class TestRunRequest(BaseModel):
+    code: str
+    cases: list[TestCase] = Field(..., min_length=1, max_length=MAX_TEST_CASES)
+    limits: Optional[ExecutionLimits] = None  # timeout_seconds applies per case
+
+
+def resolve_limits(requested: Optional[ExecutionLimits]) -> dict:
+    """Merge requested limits over the defaults and clamp them to the server caps."""
+    wanted = dict(DEFAULT_LIMITS)
+    if requested is not None:
+        for key, value in (
+            ("timeout_seconds", requested.timeout_seconds),
+            ("cpu_seconds", requested.cpu_seconds),
+            ("memory_bytes", requested.memory_mb and requested.memory_mb * 1024**2),
+            ("file_size_bytes", requested.file_size_mb and requested.file_size_mb * 1024**2),
+            ("max_processes", requested.max_processes),
+            ("output_bytes", requested.max_output_kb and requested.max_output_kb * 1024),
+        ):
+            if value is not None:
+                wanted[key] = value
+    return {key: min(value, LIMIT_CAPS[key]) for key, value in wanted.items()}
+
+
+def resolve_session_limits(requested: Optional[ExecutionLimits]) -> dict:
+    """Like resolve_limits, but the CPU budget covers the session's whole lifetime."""
+    limits = resolve_limits(requested)
+    wanted = requested.cpu_seconds if requested and requested.cpu_seconds else SESSION_CPU_SECONDS
+    limits["cpu_seconds"] = min(wanted, SESSION_CPU_SECONDS)
+    return limits
+
+
+CHUNK_SIZE = 65536
+SERVER_LIMITS = ("timeout_seconds", "output_bytes")  # enforced here, not in the child
+
+
+class OutputBuffer:
+    """Keeps the first `head` and last `tail` bytes of a stream; drops the middle."""
+
+    def __init__(self, head: int, tail: int):
+        self.head_limit = head
+        self.tail_limit = tail
+        self.head = bytearray()
+        self.tail: deque[bytes] = deque()
+        self.tail_size = 0
+        self.total = 0
+
+    @property
+    def truncated(self) -> bool:
+        return self.total > len(self.head) + self.tail_size
+
+    def append(self, data: bytes):
+        self.total += len(data)
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if not data or self.tail_limit <= 0:
+            return
+        data = data[-self.tail_limit:]
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail_size - len(self.tail[0]) >= self.tail_limit:
+            self.tail_size -= len(self.tail.popleft())
+        if self.tail_size > self.tail_limit:
+            excess = self.tail_size - self.tail_limit
+            self.tail[0] = self.tail[0][excess:]
+            self.tail_size -= excess
+
+    def text(self) -> str:
+        tail = b"".join(self.tail)
+        if self.truncated:
+            dropped = self.total - len(self.head) - len(tail)
+            body = bytes(self.head) + f"\n... [{dropped} bytes truncated] ...\n".encode() + tail
+        else:
+            body = bytes(self.head) + tail
+        return body.decode('utf-8', errors='ignore').strip()
+
+
+class ChildRun:
+    """A running sandbox child: incremental access to its output and exit status."""
+
+    def __init__(self, execution: Execution, readers: dict, transports: list):
+        self.execution = execution
+        self.started = asyncio.get_running_loop().time()
+        self.exit_code: Optional[int] = None
+        self._readers = readers
+        self._transports = transports
+
+    @classmethod
+    async def start(cls, spawn: Callable[[list[int]], Execution], stdin_data: Optional[str] = None) -> "ChildRun":
+        """Create the stdio pipes and hand the child ends to `spawn` (zygote or session)."""
+        loop = asyncio.get_running_loop()
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        if stdin_data is None:
+            stdin, in_w = os.open(os.devnull, os.O_RDONLY), None
+        else:
+            stdin, in_w = os.pipe()
+        try:
+            execution = spawn([stdin, out_w, err_w])
+        except Exception:
+            for fd in (out_r, err_r, in_w):
+                if fd is not None:
+                    os.close(fd)
+            raise
+        finally:
+            # The receiver got its own copies with the request
+            for fd in (stdin, out_w, err_w):
+                os.close(fd)
+
+        readers, transports = {}, []
+        for stream, fd in (("stdout", out_r), ("stderr", err_r)):
+            reader = asyncio.StreamReader(limit=CHUNK_SIZE)
+            transport, _ = await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb", buffering=0)
+            )
+            readers[stream] = reader
+            transports.append(transport)
+        if in_w is not None:
+            transport, _ = await loop.connect_write_pipe(asyncio.Protocol, os.fdopen(in_w, "wb", buffering=0))
+            transport.write(stdin_data.encode())
+            transport.close()  # Flushes what is buffered, then closes the child's stdin
+        return cls(execution, readers, transports)
+
+    async def output(self, deadline: float):
+        """Yield (stream, bytes) chunks as the child writes them, until both pipes hit EOF."""
+        loop = asyncio.get_running_loop()
+        pending = {asyncio.ensure_future(r.read(CHUNK_SIZE)): name for name, r in self._readers.items()}
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise TimeoutError
+                for task in done:
+                    name = pending.pop(task)
+                    data = task.result()
+                    if data:
+                        pending[asyncio.ensure_future(self._readers[name].read(CHUNK_SIZE))] = name
+                        yield name, data
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def wait(self, deadline: float) -> int:
+        loop = asyncio.get_running_loop()
+        fut = asyncio.wrap_future(self.execution.exit_code)
+        done, _ = await asyncio.wait({fut}, timeout=max(0.0, deadline - loop.time()))
+        if not done:
+            fut.cancel()
+            raise TimeoutError
+        self.exit_code = fut.result()
+        self.finished = loop.time()
+        return self.exit_code
+
+    def usage(self) -> dict:
+        """Wall time so far (or until exit) plus the child's rusage once reaped."""
+        end = self.finished if self.exit_code is not None else asyncio.get_running_loop().time()
+        usage = {"wall_ms": round((end - self.started) * 1000, 2)}
+        rusage = self.execution.rusage
+        if self.exit_code is not None and rusage:
+            usage.update(
+                cpu_user_ms=round(rusage["user_seconds"] * 1000, 2),
+                cpu_sys_ms=round(rusage["sys_seconds"] * 1000, 2),
+                max_rss_kb=rusage["max_rss_kb"],
+            )
+        return usage
+
+    def close(self):
+        """Release the pipes; kills the child if it has not been reaped yet."""
+        if self.exit_code is None:
+            self.execution.kill()
+        for transport in self._transports:
+            transport.close()
+
+
+def _child_limits(limits: dict) -> dict:
+    return {k: v for k, v in limits.items() if k not in SERVER_LIMITS}
+
+
+async def sandboxed_exec(code: str, limits: dict = DEFAULT_LIMITS, stdin_data: Optional[str] = None):
+    """Execute untrusted code with strict limits"""
+    spawn = functools.partial(pool.spawn, code, _child_limits(limits))
+    return await run_to_completion(spawn, limits, stdin_data)
+
+
+async def run_to_completion(spawn: Callable[[list[int]], Execution], limits: dict, stdin_data: Optional[str]):
+    """Run one child (or session cell) under the timeout and output budget; collect its result."""
+    loop = asyncio.get_running_loop()
+    timeout = limits["timeout_seconds"]
+    deadline = loop.time() + timeout
+    run = await ChildRun.start(spawn, stdin_data)
+    buffers = {s: OutputBuffer(OUTPUT_HEAD_BYTES, OUTPUT_TAIL_BYTES) for s in ("stdout", "stderr")}
+    over_budget = False
+    try:
+        async with aclosing(run.output(deadline)) as chunks:
+            async for stream, data in chunks:
+                buffers[stream].append(data)
+                if buffers["stdout"].total + buffers["stderr"].total > limits["output_bytes"]:
+                    # Stop reading and kill right away instead of draining a runaway writer
+                    over_budget = True
+                    run.execution.kill()
+                    break
+        exit_code = await run.wait(deadline)
+    except TimeoutError:
         return {
             "success": False,
             "stdout": "",
-            "stderr": "Execution timeout (10s)",
-            "exit_code": 408
+            "stderr": f"Execution timeout ({timeout:g}s)",
+            "exit_code": 408,
+            "truncated": False,
+            "usage": run.usage(),
         }
+    finally:
+        run.close()
+
+    stderr = buffers["stderr"].text()
+    if over_budget:
+        note = f"Output limit exceeded ({limits['output_bytes']} bytes); process killed"
+        stderr = f"{stderr}\n{note}".strip()
+    return {
+        "success": exit_code == 0 and not over_budget,
+        "stdout": buffers["stdout"].text(),
+        "stderr": stderr,
+        "exit_code": exit_code,
+        "truncated": over_budget or any(b.truncated for b in buffers.values()),
+        "usage": run.usage(),
+    }
+
+
+def _busy_result(exc: QueueFull) -> dict:
+    return {
+        "success": False,
+        "stdout": "",
+        "stderr": str(exc),
+        "exit_code": 429,
+        "retry_after": exc.retry_after,
+    }
+
+
+def _error_result(exc: Exception) -> dict:
+    """A run the sandbox itself failed to carry out."""
+    return {
+        "success": False,
+        "stdout": "",
+        "stderr": f"Sandbox error: {str(exc)}",
+        "exit_code": 500,
+    }
+
+
+def _busy_response(exc: QueueFull) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(exc.retry_after)},
+        content=_busy_result(exc),
+    )
+
+
+def _reject(exc: QueueFull) -> JSONResponse:
+    """Count a rejection that never reached run_execution and answer 429."""
+    metrics.executions.inc("rejected")
+    return _busy_response(exc)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_execution(request: ExecuteRequest):
+    """
+    Server-sent events for one execution: `stdout` / `stderr` events carry text
+    as the child produces it, then a single `exit` event carries the final status.
+    If the client disconnects, the generator is closed and the child is killed.
+    """
+    limits = resolve_limits(request.limits)
+    timeout = limits["timeout_seconds"]
+    spawn = functools.partial(pool.spawn, request.code, _child_limits(limits))
+    try:
+        async with engine.slot() as queue_seconds:
+            deadline = asyncio.get_running_loop().time() + timeout
+            try:
+                run = await ChildRun.start(spawn, request.stdin)
+            except Exception as e:
+                yield _sse("exit", _error_result(e))
+                return
+            decoders = {s: codecs.getincrementaldecoder("utf-8")(errors="ignore") for s in ("stdout", "stderr")}
+            sent = 0
+            try:
+                async with aclosing(run.output(deadline)) as chunks:
+                    async for stream, data in chunks:
+                        room = limits["output_bytes"] - sent
+                        sent += len(data)
+                        text = decoders[stream].decode(data[:max(room, 0)])
+                        if text:
+                            yield _sse(stream, {"data": text})
+                        if sent > limits["output_bytes"]:
+                            run.execution.kill()
+                            break
+                exit_code = await run.wait(deadline)
+                truncated = sent > limits["output_bytes"]
+                final = {"success": exit_code == 0 and not truncated, "exit_code": exit_code, "truncated": truncated}
+                if truncated:
+                    final["stderr"] = f"Output limit exceeded ({limits['output_bytes']} bytes); process killed"
+            except TimeoutError:
+                final = {"success": False, "stderr": f"Execution timeout ({timeout:g}s)", "exit_code": 408}
+            finally:
+                run.close()
+            final["usage"] = {**run.usage(), "queue_ms": round(queue_seconds * 1000, 2)}
+            metrics.record(final)
+    except QueueFull as e:
+        final = _busy_result(e)
+        metrics.record(final)
+    yield _sse("exit", final)
+
+# Server-side outcomes that say nothing about the code itself
+_UNCACHEABLE_EXIT_CODES = {408, 429, 500}
+
+
+async def run_execution(request: ExecuteRequest) -> dict:
+    """
+    Serve from the result cache or wait for an execution slot and run.
+    Sandbox faults become a 500-style result.
+    """
+    limits = resolve_limits(request.limits)
+    key = None
+    if cache.enabled and not request.no_cache:
+        key = cache.key(request.code, request.stdin, limits)
+        cached = cache.get(key)
+        if cached is not None:
+            return {**cached, "cached": True}
+    try:
+        async with engine.slot() as queue_seconds:
+            result = await sandboxed_exec(request.code, limits, request.stdin)
+            result.setdefault("usage", {})["queue_ms"] = round(queue_seconds * 1000, 2)
+    except QueueFull:
+        metrics.executions.inc("rejected")
+        raise
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        result = _error_result(e)
+    metrics.record(result)
+    if key is not None and result["exit_code"] not in _UNCACHEABLE_EXIT_CODES:
+        # A hit does not run anything, so it must not report this run's costs
+        cache.put(key, {**result, "usage": dict.fromkeys(result.get("usage", {}), 0)})
+    return {**result, "cached": False}
+
+async def run_project(request: ProjectRunRequest) -> dict:
+    """Unpack the project into a fresh workspace, run it there, and remove the workspace."""
+    if (request.entry_point is None) == (request.module is None):
+        raise HTTPException(status_code=400, detail="Give exactly one of entry_point or module")
+    if request.module is not None and request.module not in WORKSPACE_MODULES:
+        raise HTTPException(status_code=400, detail=f"Module not allowed: {request.module} (allowed: {', '.join(sorted(WORKSPACE_MODULES))})")
+    if not request.files and not request.archive:
+        raise HTTPException(status_code=400, detail="Project has no files")
+    limits = resolve_limits(request.limits)
+
+    async with engine.slot() as queue_seconds:
+        # Unpack only once a slot is ours, so queued runs hold no workspace memory
+        workspace = Workspace(WORKSPACE_ROOT, MAX_WORKSPACE_BYTES, MAX_WORKSPACE_FILES)
+        try:
+            try:
+                if request.archive:
+                    workspace.add_archive(base64.b64decode(request.archive, validate=True))
+                for f in request.files:
+                    workspace.add(f.path, f.code.encode())
+                if request.entry_point is not None:
+                    entry_point = workspace.relative(request.entry_point)
+                    if not os.path.isfile(os.path.join(workspace.path, entry_point)):
+                        raise WorkspaceError(f"Entry point not found in project: {request.entry_point}")
+                    target = {"path": entry_point}
+                else:
+                    target = {"module": request.module}
+            except WorkspaceError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            except ValueError as e:  # bad base64
+                raise HTTPException(status_code=400, detail=f"Invalid project archive: {e}")
+
+            execution = None
+
+            def spawn(fds: list[int]) -> Execution:
+                nonlocal execution
+                execution = pool.spawn(None, _child_limits(limits), fds, cwd=workspace.path, args=request.args, **target)
+                return execution
+
+            guard = workspace.guard(lambda: execution and execution.kill(), WORKSPACE_CHECK_SECONDS)
+            try:
+                result = await run_to_completion(spawn, limits, request.stdin)
+                result["usage"]["queue_ms"] = round(queue_seconds * 1000, 2)
+            except Exception as e:
+                result = _error_result(e)
+            finally:
+                guard.cancel()
+            if workspace.overflow:
+                result.update(success=False, stderr=f"{result['stderr']}\n{workspace.overflow}".strip())
+        finally:
+            workspace.close()
+    metrics.record(result)
+    return {**result, "workspace": {"files": workspace.files, "bytes": workspace.bytes}}
+
+
+def _output_matches(actual: str, expected: str) -> bool:
+    """Compare stdout the way judges usually do: ignore trailing whitespace."""
+    lines = lambda text: [line.rstrip() for line in text.strip().splitlines()]
+    return lines(actual) == lines(expected)
+
+
+async def run_test_cases(request: TestRunRequest) -> dict:
+    """
+    Compile the code once in a runner forked from a zygote, then run every case
+    in a fresh child forked from that runner, one after another, each under its
+    own timeout and output budget.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    limits = resolve_limits(request.limits)
+    results = []
+    async with engine.slot() as queue_seconds:
+        try:
+            runner = CaseRunner(request.code, limits)
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Sandbox error: {str(e)}")
+        try:
+            for index, case in enumerate(request.cases):
+                case_limits = dict(limits)
+                if case.timeout_seconds is not None:
+                    case_limits["timeout_seconds"] = min(case.timeout_seconds, LIMIT_CAPS["timeout_seconds"])
+                spawn = functools.partial(runner.spawn_case, case.args)
+                try:
+                    result = await run_to_completion(spawn, case_limits, case.stdin)
+                except Exception as e:
+                    result = _error_result(e)
+                metrics.record(result)
+                result["status"] = _execution_status(result)
+                result["passed"] = result["success"] and (
+                    case.expected_stdout is None or _output_matches(result["stdout"], case.expected_stdout)
+                )
+                results.append({"index": index, **result})
+        finally:
+            runner.close()
+
+    passed = sum(r["passed"] for r in results)
+    return {
+        "results": results,
+        "passed": passed,
+        "failed": len(results) - passed,
+        "all_passed": passed == len(results),
+        "queue_ms": round(queue_seconds * 1000, 2),
+        "total_ms": round((loop.time() - started) * 1000, 2),
+    }
 
 @app.get("/health")
 async def health():
     return {"status": "healthy"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return cache.stats()
+
 @app.post("/execute")
-async def execute_code(request: ExecuteRequest):
+async def execute_code(request: ExecuteRequest, http_request: Request):
     try:
-        return sandboxed_exec(request.code)
-    except Exception as e:
-        return {
-            "success": False,
-            "stdout": "",
-            "stderr": f"Sandbox error: {str(e)}",
-            "exit_code": 500
-        }
+        return await cancel_on_disconnect(http_request, run_execution(request))
+    except QueueFull as e:
+        return _busy_response(e)
+    except ClientDisconnected:
+        # A queued request gave up its place, or its running child was killed, freeing the slot
+        metrics.disconnects.inc()
+        return Response(status_code=499)
+
+@app.post("/execute/stream")
+async def execute_stream(request: ExecuteRequest):
+    """Like /execute, but streams output as server-sent events (never cached)."""
+    if engine.full():
+        return _reject(QueueFull(engine.retry_after()))
+    return StreamingResponse(
+        stream_execution(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/sessions")
+async def create_session(request: SessionCreateRequest):
+    """Start a persistent interpreter; run cells against it until closed or idle-evicted."""
+    try:
+        session = sessions.create(resolve_session_limits(request.limits))
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=f"Sandbox error: {str(e)}")
+    return {**session.info(), "limits": session.limits, "idle_timeout_seconds": sessions.idle_seconds}
+
+@app.get("/sessions")
+async def list_sessions():
+    return {
+        "sessions": [s.info() for s in sessions.sessions.values()],
+        "max_sessions": sessions.max_sessions,
+        "evicted": sessions.evicted,
+    }
+
+@app.post("/sessions/{session_id}/execute")
+async def execute_in_session(session_id: str, request: CellRequest):
+    session = sessions.get(session_id)
+    async with session.lock:
+        sessions.get(session_id)  # The cell ahead of this one may have ended the session
+        try:
+            async with engine.slot() as queue_seconds:
+                result = await session.run_cell(request.code, request.stdin)
+                result["usage"]["queue_ms"] = round(queue_seconds * 1000, 2)
+        except QueueFull as e:
+            return _reject(e)
+        except Exception as e:
+            result = _error_result(e)
+    metrics.record(result)
+    if not session.alive:
+        sessions.close(session_id)
+    return {**result, "session_id": session_id, "cell": session.cells, "session_closed": not session.alive}
+
+@app.delete("/sessions/{session_id}")
+async def close_session(session_id: str):
+    if not sessions.close(session_id):
+        raise HTTPException(status_code=404, detail=f"Unknown or closed session: {session_id}")
+    return {"session_id": session_id, "closed": True}
+
+@app.post("/execute_batch")
+async def execute_batch(request: BatchRequest):
+    """
+    Run independent snippets in parallel across the worker pool.
+
+    Results come back in input order. At most `concurrency` items of one batch
+    compete for execution slots at a time, so a large batch queues inside the
+    batch instead of overflowing the shared wait queue. Items still running when
+    the overall deadline passes are killed and reported as `deadline_exceeded`.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = min(request.deadline_seconds or MAX_BATCH_DEADLINE_SECONDS, MAX_BATCH_DEADLINE_SECONDS)
+    admission = asyncio.Semaphore(engine.concurrency)
+
+    async def run_item(item: BatchItem) -> dict:
+        async with admission:
+            item_started = loop.time()
+            try:
+                result = await run_execution(item)
+            except QueueFull as e:
+                result = _busy_result(e)
+            result["duration_ms"] = round((loop.time() - item_started) * 1000, 2)
+            result["status"] = _execution_status(result)
+            return result
+
+    tasks = [asyncio.create_task(run_item(item)) for item in request.items]
+    _, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    results = []
+    for index, task in enumerate(tasks):
+        if task in pending:
+            result = {
+                "success": False,
+                "stdout": "",
+                "stderr": f"Batch deadline exceeded ({deadline:g}s)",
+                "exit_code": 408,
+                "status": "deadline_exceeded",
+                "duration_ms": None,
+            }
+        else:
+            result = task.result()
+        results.append({"index": index, **result})
+
+    return {
+        "results": results,
+        "completed": len(tasks) - len(pending),
+        "deadline_exceeded": bool(pending),
+        "total_ms": round((loop.time() - started) * 1000, 2),
+    }
+
+@app.post("/execute_project")
+async def execute_project(request: ProjectRunRequest):
+    """Run a multi-file project (entry point or test module) in a private, in-memory workspace."""
+    try:
+        return await run_project(request)
+    except QueueFull as e:
+        return _reject(e)
+
+@app.post("/execute_tests")
+async def execute_tests(request: TestRunRequest):
+    """Run one program against many stdin/argv cases and report pass/fail per case."""
+    try:
+        return await run_test_cases(request)
+    except QueueFull as e:
+        return _reject(e)
 
 if __name__ == "__main__":
     uvicorn.run("sandbox-server:app", host="0.0.0.0", port=8001)
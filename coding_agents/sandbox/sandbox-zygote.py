@@ -0,0 +1,412 @@
+"""
+Warm zygote for the sandbox server.
+
+The sandbox server starts a small pool of these processes. Each one imports the
+commonly used stdlib modules once and then forks a clean child per execution,
+so requests skip interpreter startup and site import entirely.
+
+Protocol (over the UNIX socket whose fd is passed as argv[1]):
+- server -> zygote: 4-byte big-endian length + JSON request, with the child's
+  stdin/stdout/stderr fds attached via SCM_RIGHTS.
+- zygote -> server: one JSON line per event, {"id", "pid"} once the child is
+  forked and {"id", "exit_code", "rusage"} once it has been reaped (wait4).
+
+A request with "mode": "session" forks a persistent interpreter instead. It gets
+a fourth fd, its own control socket, and speaks the same protocol on it: each
+framed request is one cell (code plus that cell's stdio fds), answered with
+{"id", "pid"} and {"id", "exit_code", "rusage"}. Globals persist between cells.
+
+A request with "mode": "runner" compiles its code once and then serves test
+cases on the same kind of control socket: each framed request carries a case's
+"args" and stdio fds, and the runner forks a fresh child from the compiled state
+to run it, answering with the case child's pid and its wait4 exit/rusage.
+
+An exec request may name a "path" (run that file, like `python path args...`) or
+a "module" (like `python -m module args...`) instead of inline code. As with
+python, the file's directory or, for a module, the "cwd" then goes first on sys.path.
+
+Limits are applied in the child only. When the request names a cgroup v2 root,
+the child joins its own sub-cgroup (memory.max, pids.max) and the per-user /
+address-space rlimits are skipped; CPU time and file size stay rlimits.
+"""
+import json
+import os
+import resource
+import selectors
+import signal
+import socket
+import struct
+import sys
+
+HEADER = struct.Struct(">I")
+
+RLIMITS = {
+    "cpu_seconds": resource.RLIMIT_CPU,
+    "memory_bytes": resource.RLIMIT_AS,
+    "file_size_bytes": resource.RLIMIT_FSIZE,
+    "max_processes": resource.RLIMIT_NPROC,
+}
+
+
+def preload(modules: str) -> None:
+    """Import stdlib modules up front so forked children get them for free."""
+    for name in filter(None, (m.strip() for m in modules.split(","))):
+        try:
+            __import__(name)
+        except Exception:
+            pass
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = b""
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise EOFError
+        buf += chunk
+    return buf
+
+
+def recv_request(sock: socket.socket) -> tuple[dict, list[int]]:
+    """Read one framed request and the fds attached to it."""
+    header, fds, _, _ = socket.recv_fds(sock, HEADER.size, 4)
+    if not header:
+        raise EOFError
+    if len(header) < HEADER.size:
+        header += recv_exact(sock, HEADER.size - len(header))
+    (length,) = HEADER.unpack(header)
+    return json.loads(recv_exact(sock, length)), fds
+
+
+def send_event(sock: socket.socket, event: dict) -> None:
+    sock.sendall(json.dumps(event).encode() + b"\n")
+
+
+# Enforced by the cgroup instead of an rlimit when the child runs in one
+CGROUP_FILES = {
+    "memory_bytes": "memory.max",
+    "max_processes": "pids.max",
+}
+
+
+def write_file(path: str, value) -> None:
+    with open(path, "w") as f:
+        f.write(str(value))
+
+
+def make_cgroup(root: str, request_id: int, limits: dict) -> str:
+    path = os.path.join(root, f"exec-{os.getpid()}-{request_id}")
+    os.mkdir(path)
+    try:
+        for key, filename in CGROUP_FILES.items():
+            if limits.get(key) is not None:
+                write_file(os.path.join(path, filename), limits[key])
+        try:
+            write_file(os.path.join(path, "memory.swap.max"), 0)
+        except OSError:
+            pass  # No swap accounting on this host
+    except OSError:
+        os.rmdir(path)
+        raise
+    return path
+
+
+def remove_cgroup(path: str) -> bool:
+    """Remove a child's cgroup, killing stragglers first. False if it is still busy."""
+    try:
+        os.rmdir(path)
+        return True
+    except FileNotFoundError:
+        return True
+    except OSError:
+        try:
+            write_file(os.path.join(path, "cgroup.kill"), 1)
+        except OSError:
+            pass
+        return False
+
+
+def apply_limits(limits: dict, in_cgroup: bool) -> None:
+    for key, value in limits.items():
+        if in_cgroup and key in CGROUP_FILES:
+            continue
+        if key in RLIMITS and value is not None:
+            resource.setrlimit(RLIMITS[key], (value, value))
+
+
+def exit_code_for(exc: SystemExit) -> int:
+    """Mirror how the interpreter turns SystemExit into a process status."""
+    code = exc.code
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code & 0xFF
+    print(code, file=sys.stderr)
+    return 1
+
+
+def new_main(argv: list[str]):
+    import builtins
+    import types
+
+    main = types.ModuleType("__main__")
+    main.__builtins__ = builtins
+    sys.modules["__main__"] = main
+    sys.argv = argv
+    return main
+
+
+def execute(code, namespace: dict, filename: str = "<string>") -> tuple[int, bool]:
+    """Exec source or a code object, printing uncaught tracebacks. Returns (status, raised SystemExit)."""
+    try:
+        if isinstance(code, str):
+            code = compile(code, filename, "exec")
+        exec(code, namespace)
+        return 0, False
+    except SystemExit as e:
+        return exit_code_for(e), True
+    except BaseException as e:
+        # Drop this frame so tracebacks start at "<string>", like `python -c`.
+        e.__traceback__ = e.__traceback__.tb_next
+        sys.excepthook(type(e), e, e.__traceback__)
+        return 1, False
+
+
+def flush_stdio() -> None:
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except Exception:
+            pass
+
+
+def run_code(code, argv: list[str], filename: str = "<string>") -> int:
+    """Run code as `python -c` would: fresh __main__, same tracebacks, same exit status."""
+    main = new_main(argv)
+    if filename != "<string>":
+        main.__file__ = filename
+    status, _ = execute(code, main.__dict__, filename)
+    try:
+        import atexit
+        import threading
+
+        threading._shutdown()
+        atexit._run_exitfuncs()
+    except BaseException:
+        pass
+    flush_stdio()
+    return status
+
+
+def cpu_seconds() -> tuple[float, float]:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime, usage.ru_stime
+
+
+def session_main(control: socket.socket) -> None:
+    """Persistent interpreter: run cells against one __main__ until the server hangs up."""
+    namespace = new_main(["-c"]).__dict__
+    devnull = os.open(os.devnull, os.O_RDWR)
+    while True:
+        try:
+            request, fds = recv_request(control)
+        except (EOFError, ConnectionError):
+            return
+        send_event(control, {"id": request["id"], "pid": os.getpid()})
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = open(0, closefd=False)  # Drop anything buffered from an earlier cell
+        user, system = cpu_seconds()
+        status, exited = execute(request["code"], namespace)
+        flush_stdio()
+        # Release this cell's pipes so the server sees EOF
+        for target in range(3):
+            os.dup2(devnull, target)
+        user_after, system_after = cpu_seconds()
+        send_event(control, {
+            "id": request["id"],
+            "exit_code": status,
+            "rusage": {
+                "user_seconds": user_after - user,
+                "sys_seconds": system_after - system,
+                "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            },
+            "session_ended": exited,
+        })
+        if exited:
+            return
+
+
+def runner_main(control: socket.socket, code: str) -> None:
+    """Compile once, then fork one child per test case until the server hangs up."""
+    try:
+        compiled = compile(code, "<string>", "exec")
+    except (SyntaxError, ValueError):
+        compiled = code  # Every case then reports the error just like `python -c`
+    while True:
+        try:
+            request, fds = recv_request(control)
+        except (EOFError, ConnectionError):
+            return
+        try:
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.setpgid(0, 0)  # Own group so the server can killpg just this case
+                    for target, fd in enumerate(fds):
+                        os.dup2(fd, target)
+                    os.closerange(len(fds), os.sysconf("SC_OPEN_MAX"))
+                    os._exit(run_code(compiled, ["-c", *(request.get("args") or [])]))
+                finally:
+                    os._exit(70)
+        except OSError as e:
+            send_event(control, {"id": request["id"], "error": str(e)})
+            continue
+        finally:
+            for fd in fds:
+                os.close(fd)
+        send_event(control, {"id": request["id"], "pid": pid})
+        _, status, usage = os.wait4(pid, 0)
+        send_event(control, {
+            "id": request["id"],
+            "exit_code": os.waitstatus_to_exitcode(status),
+            "rusage": {
+                "user_seconds": usage.ru_utime,
+                "sys_seconds": usage.ru_stime,
+                "max_rss_kb": usage.ru_maxrss,
+            },
+        })
+
+
+def child_main(request: dict, fds: list[int], cgroup: str | None) -> None:
+    """Runs in the forked child: detach, wire up stdio, limit, execute, exit."""
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    os.setsid()  # Session leader so the server can killpg the whole tree
+    in_cgroup = False
+    if cgroup:
+        try:
+            write_file(os.path.join(cgroup, "cgroup.procs"), 0)
+            in_cgroup = True
+        except OSError:
+            pass  # Fall back to rlimits for everything
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+    os.closerange(len(fds), os.sysconf("SC_OPEN_MAX"))
+    apply_limits(request.get("limits") or {}, in_cgroup)
+    cwd = request.get("cwd") or "/tmp"
+    os.chdir(cwd)
+    sys.path[0] = ""  # As for `python -c` and the REPL: imports see the cwd, not the zygote's directory
+    if request.get("mode") == "session":
+        session_main(socket.socket(fileno=3))
+        os._exit(0)
+    if request.get("mode") == "runner":
+        runner_main(socket.socket(fileno=3), request["code"])
+        os._exit(0)
+    args = request.get("args") or []
+    if request.get("path"):
+        sys.path[0] = os.path.dirname(os.path.abspath(request["path"]))  # Sibling modules import like under `python path`
+        with open(request["path"]) as f:
+            source = f.read()
+        os._exit(run_code(source, [request["path"], *args], request["path"]))
+    if request.get("module"):
+        sys.path[0] = cwd
+        launcher = f"import runpy\nrunpy.run_module({request['module']!r}, run_name='__main__', alter_sys=True)"
+        os._exit(run_code(launcher, ["-m", *args]))
+    os._exit(run_code(request["code"], ["-c", *args]))
+
+
+def spawn(request: dict, fds: list[int], cgroup: str | None) -> int:
+    try:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                child_main(request, fds, cgroup)
+            finally:
+                os._exit(70)
+    finally:
+        # The child holds its own copies; the zygote must not keep pipes open.
+        for fd in fds:
+            os.close(fd)
+    return pid
+
+
+def main() -> None:
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    preload(sys.argv[2] if len(sys.argv) > 2 else "")
+
+    # SIGCHLD wakes the selector through this pipe so exits are reported immediately.
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ, "control")
+    selector.register(wake_r, selectors.EVENT_READ, "sigchld")
+    children: dict[int, tuple[int, str | None]] = {}  # pid -> (request id, cgroup)
+    stale_cgroups: list[str] = []
+
+    while True:
+        for key, _ in selector.select():
+            if key.data == "sigchld":
+                try:
+                    while os.read(wake_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            try:
+                request, fds = recv_request(sock)
+            except (EOFError, ConnectionError):
+                # Server went away; take any running children with us.
+                for pid in children:
+                    try:
+                        os.killpg(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                return
+            cgroup = None
+            try:
+                if request.get("cgroup"):
+                    try:
+                        cgroup = make_cgroup(request["cgroup"], request["id"], request.get("limits") or {})
+                    except OSError:
+                        pass  # Child falls back to rlimits
+                pid = spawn(request, fds, cgroup)
+            except OSError as e:
+                if cgroup:
+                    remove_cgroup(cgroup)
+                send_event(sock, {"id": request["id"], "error": str(e)})
+                continue
+            children[pid] = (request["id"], cgroup)
+            send_event(sock, {"id": request["id"], "pid": pid})
+
+        while children:
+            try:
+                pid, status, usage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid not in children:
+                continue
+            request_id, cgroup = children.pop(pid)
+            if cgroup:
+                stale_cgroups.append(cgroup)
+            send_event(sock, {
+                "id": request_id,
+                "exit_code": os.waitstatus_to_exitcode(status),
+                "rusage": {
+                    "user_seconds": usage.ru_utime,
+                    "sys_seconds": usage.ru_stime,
+                    "max_rss_kb": usage.ru_maxrss,
+                },
+            })
+        stale_cgroups[:] = [path for path in stale_cgroups if not remove_cgroup(path)]
+
+
+if __name__ == "__main__":
+    main()
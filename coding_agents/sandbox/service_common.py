@@ -0,0 +1,90 @@
+"""
+Pieces shared by codegen-server.py and sandbox-server.py: Prometheus text-format
+metrics and cancelling a request's work when its client hangs up. Both
+Dockerfiles copy this file next to the service.
+"""
+from typing import Any, Awaitable
+import asyncio
+
+from fastapi import Request
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...], labels: tuple[str, ...] = ()):
+        self.name, self.help, self.buckets, self.labels = name, help, buckets, labels
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
+        if not labels:
+            # An unlabelled histogram has exactly one series; export it even before the first observation
+            self.counts[()] = [0] * (len(buckets) + 1)
+            self.sums[()] = 0.0
+
+    def observe(self, value: float, *label_values):
+        counts = self.counts.setdefault(label_values, [0] * (len(self.buckets) + 1))
+        self.sums[label_values] = self.sums.get(label_values, 0.0) + value
+        counts[-1] += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ("le",)
+        for label_values, counts in sorted(self.counts.items()):
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                lines.append(f"{self.name}_bucket{format_labels(bucket_labels, label_values + (bound,))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {self.sums[label_values]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {counts[-1]}")
+        return lines
+
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def cancel_on_disconnect(http_request: Request, work: Awaitable[Any]) -> Any:
+    """
+    Await `work`, but cancel it as soon as the client hangs up, and raise
+    ClientDisconnected once it has unwound (so whatever it held, such as an
+    execution slot or an upstream connection, is free again).
+    """
+    task = asyncio.ensure_future(work)
+
+    async def disconnected():
+        while (await http_request.receive())["type"] != "http.disconnect":
+            pass
+
+    watcher = asyncio.create_task(disconnected())
+    try:
+        await asyncio.wait((task, watcher), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        finished = task.done()
+        if not finished:
+            task.cancel()
+    if finished:
+        return task.result()
+    await asyncio.gather(task, return_exceptions=True)
+    raise ClientDisconnected()
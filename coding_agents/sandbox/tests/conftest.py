@@ -1,39 +1,72 @@
+import importlib.util
 import pytest
+import pytest_asyncio
 import httpx
 import os
-from codegen_server import app  # Your main app
+import sys
+from types import SimpleNamespace
 
-@pytest.fixture(scope="session")
-def test_client():
-    """Live test client against running FastAPI app."""
-    with httpx.AsyncClient(app=app, base_url="http://test") as client:
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)  # The services import service_common from beside them
+
+
+def _load_service(name: str, filename: str):
+    """Import a hyphenated service file (e.g. codegen-server.py) under an importable name."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SERVICE_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+codegen_server = _load_service("codegen_server", "codegen-server.py")
+sandbox_server = _load_service("sandbox_server", "sandbox-server.py")
+_load_service("sandbox_zygote", "sandbox-zygote.py")
+app = codegen_server.app  # Your main app
+
+
+@pytest_asyncio.fixture
+async def sandbox(monkeypatch):
+    """The real sandbox app, run in process, as codegen's pooled sandbox_client."""
+    async with sandbox_server.lifespan(sandbox_server.app):
+        transport = httpx.ASGITransport(app=sandbox_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://sandbox") as client:
+            monkeypatch.setattr(codegen_server, "sandbox_client", client)
+            yield client
+
+
+@pytest_asyncio.fixture
+async def test_client(mock_openai, sandbox, monkeypatch):
+    """Client for the codegen app, wired to the mocked model and the in-process sandbox."""
+    monkeypatch.setattr(codegen_server, "prompt_cache", codegen_server.PromptCache(0, 0))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
         yield client
 
+
+def _completion(content: str):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+
 @pytest.fixture
 def mock_openai(monkeypatch):
     """Mock OpenAI responses for deterministic testing."""
-    def mock_chat_completions(model, messages, **kwargs):
+    async def mock_chat_completions(model, messages, **kwargs):
         prompt = messages[-1]["content"].lower()
         
         # Mock responses based on prompt content
         if "reverse" in prompt:
-            return type("Response", (), {
-                "choices": [type("Choice", (), {"message": type("Message", (), {"content": 'def reverse_string(s):return s[::-1];print(reverse_string("hello"))'})})]
-            })()
-        elif "count" in prompt:
-            return type("Response", (), {
-                "choices": [type("Choice", (), {"message": type("Message", (), {"content": 'print("strawberry".count("r"))'})})]
-            })()
+            return _completion('def reverse_string(s):\n    return s[::-1]\nprint(reverse_string("hello"))')
+        elif "count" in prompt or "strawberry" in prompt:
+            return _completion('print("strawberry".count("r"))')
         elif "timeout" in prompt or "infinite" in prompt:
-            return type("Response", (), {
-                "choices": [type("Choice", (), {"message": type("Message", (), {"content": 'while True:pass'})})]
-            })()
-        elif "error" in prompt:
-            return type("Response", (), {
-                "choices": [type("Choice", (), {"message": type("Message", (), {"content": 'print(undefinded_variable)'})})]
-            })()
+            return _completion('while True:pass')
+        elif "no print" in prompt:
+            return _completion('def answer():\n    return 42\nanswer()')
+        elif "failing" in prompt:
+            return _completion('print(42)')
+        elif "error" in prompt or "undefined" in prompt:
+            return _completion('print(undefinded_variable)')
         
         raise ValueError(f"No mock for prompt: {prompt}")
     
-    monkeypatch.setattr("codegen_server.client.chat.completions.create", mock_chat_completions)
-    monkeypatch.setattr("codegen_server.client", type("Client", (), {"chat": type("Chat", (), {"completions": type("Completions", (), {"create": mock_chat_completions})})})())
+    monkeypatch.setattr(codegen_server, "client", SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=mock_chat_completions))))
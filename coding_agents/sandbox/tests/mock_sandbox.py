@@ -1,21 +1,27 @@
 class MockSandbox:
+    """Stands in for codegen's sandbox_client; `buggy` fails the first run only."""
+
     def __init__(self, buggy=False, timeout=False, always_fail=False):
         self.buggy = buggy
         self.timeout = timeout
         self.always_fail = always_fail
+        self.calls = 0
     
     async def post(self, url, json, **kwargs):
-        if self.buggy:
-            return MockResponse({"success": False, "stderr": "NameError: foo"})
+        self.calls += 1
+        if self.buggy and self.calls == 1:
+            return MockResponse({"success": False, "stdout": "", "stderr": "NameError: foo"})
         if self.timeout:
-            return MockResponse({"success": False, "stderr": "Execution timeout"})
+            return MockResponse({"success": False, "stdout": "", "stderr": "Execution timeout"})
         if self.always_fail:
-            return MockResponse({"success": False, "stderr": "Test fail"})
+            return MockResponse({"success": False, "stdout": "", "stderr": "Test fail"})
         return MockResponse({"success": True, "stdout": "42"})
 
 class MockResponse:
-    def __init__(self, data):
+    def __init__(self, data, status_code=200):
         self._json = data
+        self.status_code = status_code
+        self.headers = {}
     
     def json(self):
         return self._json
@@ -0,0 +1,64 @@
+import pytest
+from codegen_server import apply_edits
+
+CODE = "def total(items):\n    return sum(item for item in items)\n\nprint(totl([1, 2, 3]))"
+
+
+def block(search: str, replace: str) -> str:
+    return f"<<<<<<< SEARCH\n{search}\n=======\n{replace}\n>>>>>>> REPLACE\n"
+
+
+class TestSearchReplace:
+    def test_applies_a_block(self):
+        patched = apply_edits(CODE, block("print(totl([1, 2, 3]))", "print(total([1, 2, 3]))"))
+
+        assert patched == CODE.replace("totl", "total")
+
+    def test_applies_several_blocks_in_order_inside_fences(self):
+        reply = "```diff\n" + block("def total(items):", "def total(items, start=0):") + block(
+            "    return sum(item for item in items)", "    return start + sum(items)"
+        ) + block("totl(", "total(") + "```"
+
+        patched = apply_edits(CODE, reply)
+
+        assert "def total(items, start=0):\n    return start + sum(items)" in patched
+        assert "print(total([1, 2, 3]))" in patched
+
+    @pytest.mark.parametrize("search", ["print(nothing_like_this)", "", "   "])
+    def test_search_that_does_not_match_rejects_the_patch(self, search):
+        assert apply_edits(CODE, block(search, "print(1)")) is None
+
+    def test_search_that_matches_several_times_rejects_the_patch(self):
+        assert apply_edits(CODE, block("item", "x")) is None
+
+    def test_one_bad_block_rejects_the_whole_reply(self):
+        reply = block("totl(", "total(") + block("missing", "x")
+
+        assert apply_edits(CODE, reply) is None
+
+    def test_result_that_does_not_compile_is_rejected(self):
+        assert apply_edits(CODE, block("print(totl([1, 2, 3]))", "print(total([1, 2, 3])")) is None
+
+    def test_reply_without_edits_is_rejected(self):
+        assert apply_edits(CODE, "print(total([1, 2, 3]))") is None
+
+
+class TestUnifiedDiff:
+    def test_applies_a_hunk_by_context(self):
+        diff = (
+            "--- a/main.py\n+++ b/main.py\n@@ -3,2 +3,2 @@\n"
+            " \n"
+            "-print(totl([1, 2, 3]))\n"
+            "+print(total([1, 2, 3]))\n"
+        )
+
+        assert apply_edits(CODE, diff) == CODE.replace("totl", "total")
+
+    def test_hunk_whose_context_does_not_match_is_rejected(self):
+        diff = "@@ -1,2 +1,2 @@\n def total(values):\n-    return 0\n+    return 1\n"
+
+        assert apply_edits(CODE, diff) is None
+
+    def test_hunk_that_only_adds_lines_is_rejected(self):
+        # Without context there is nowhere to anchor it
+        assert apply_edits(CODE, "@@ -0,0 +1 @@\n+import math\n") is None
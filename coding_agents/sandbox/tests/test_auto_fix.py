@@ -1,11 +1,13 @@
 import pytest
 from httpx import AsyncClient
+import codegen_server
+from mock_sandbox import MockSandbox
 
 class TestAutoFixing:
     @pytest.mark.asyncio
     async def test_syntax_error_fix(self, test_client: AsyncClient, monkeypatch):
         # Mock initial buggy response
-        monkeypatch.setattr("httpx.AsyncClient", lambda *a, **kw: MockSandbox(buggy=True))
+        monkeypatch.setattr(codegen_server, "sandbox_client", MockSandbox(buggy=True))
         
         response = await test_client.post("/generate", json={
             "prompt": "Write function counting vowels",
@@ -18,7 +20,7 @@ class TestAutoFixing:
 
     @pytest.mark.asyncio
     async def test_timeout_fix(self, test_client: AsyncClient, monkeypatch):
-        monkeypatch.setattr("httpx.AsyncClient", lambda *a, **kw: MockSandbox(timeout=True))
+        monkeypatch.setattr(codegen_server, "sandbox_client", MockSandbox(timeout=True))
         
         response = await test_client.post("/generate", json={
             "prompt": "Write infinite loop (will timeout)"
@@ -30,7 +32,7 @@ class TestAutoFixing:
 
     @pytest.mark.asyncio
     async def test_max_iterations(self, test_client: AsyncClient, monkeypatch):
-        monkeypatch.setattr("httpx.AsyncClient", lambda *a, **kw: MockSandbox(always_fail=True))
+        monkeypatch.setattr(codegen_server, "sandbox_client", MockSandbox(always_fail=True))
         
         response = await test_client.post("/generate", json={
             "prompt": "Always failing test",
@@ -0,0 +1,38 @@
+import pytest
+import sandbox_server
+
+
+class TestBatch:
+    @pytest.mark.asyncio
+    async def test_results_in_input_order(self, sandbox):
+        items = [{"code": f"print({i})", "no_cache": True} for i in range(5)]
+
+        response = await sandbox.post("/execute_batch", json={"items": items})
+
+        data = response.json()
+        assert [r["stdout"].strip() for r in data["results"]] == ["0", "1", "2", "3", "4"]
+        assert [r["index"] for r in data["results"]] == [0, 1, 2, 3, 4]
+        assert data["completed"] == 5
+        assert not data["deadline_exceeded"]
+
+    @pytest.mark.asyncio
+    async def test_deadline_kills_what_is_still_running(self, sandbox):
+        # Slow item last, so the others are not queued behind it when there are few slots
+        items = [
+            {"code": "print('quick')", "no_cache": True},
+            {"code": "print(1 / 0)", "no_cache": True},
+            {"code": "import time\ntime.sleep(30)", "no_cache": True},
+        ]
+
+        response = await sandbox.post("/execute_batch", json={"items": items, "deadline_seconds": 1})
+
+        data = response.json()
+        quick, failing, slow = data["results"]
+        assert quick["status"] == "success" and quick["stdout"].strip() == "quick"
+        assert failing["status"] == "failed" and "ZeroDivisionError" in failing["stderr"]
+        assert slow["status"] == "deadline_exceeded"
+        assert slow["exit_code"] == 408
+        assert data["completed"] == 2
+        assert data["deadline_exceeded"]
+        assert data["total_ms"] < 10_000
+        assert sandbox_server.engine.running == 0  # The slow child was killed, not left running
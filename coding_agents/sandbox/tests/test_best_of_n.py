@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+import codegen_server
+from codegen_server import _race_candidates, auto_fix_loop
+
+
+def scripted_attempts(monkeypatch, script: list[tuple[float, object]]) -> dict:
+    """
+    Replace _attempt: the i-th call waits script[i][0] seconds, then returns a
+    passing attempt (True), a failing one (False) or raises the given exception.
+    Returns which calls finished and which were cancelled.
+    """
+    calls = {"finished": [], "cancelled": []}
+    started: list[int] = []
+
+    async def attempt(prompt, temperature, spans=None):
+        index = len(started)
+        started.append(index)
+        delay, outcome = script[index]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            calls["cancelled"].append(index)
+            raise
+        calls["finished"].append(index)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return {
+            "content": f"print({index})", "code": f"print({index})",
+            "sandbox": {"success": outcome, "stdout": f"{index}\n" if outcome else "", "stderr": "" if outcome else "boom"},
+            "needs_fix": not outcome, "error_type": "Success" if outcome else "OTHER_ERROR",
+            "sandbox_skipped": False, "prompt_tokens": 10, "cached_tokens": 0, "timings": {},
+        }
+
+    monkeypatch.setattr(codegen_server, "_attempt", attempt)
+    return calls
+
+
+class TestRaceCandidates:
+    @pytest.mark.asyncio
+    async def test_first_passing_attempt_wins_and_the_rest_are_cancelled(self, monkeypatch):
+        calls = scripted_attempts(monkeypatch, [(5, True), (0.01, False), (0.05, True), (5, True)])
+
+        winner, finished = await _race_candidates("task", 0.7, 4)
+        await asyncio.sleep(0)  # Let the cancellations land
+
+        assert winner["code"] == "print(2)"
+        assert [a["code"] for a in finished] == ["print(1)", "print(2)"]
+        assert sorted(calls["cancelled"]) == [0, 3]
+
+    @pytest.mark.asyncio
+    async def test_without_a_pass_the_first_to_finish_is_returned(self, monkeypatch):
+        scripted_attempts(monkeypatch, [(0.03, False), (0.01, False), (0.02, RuntimeError("model down"))])
+
+        winner, finished = await _race_candidates("task", 0.7, 3)
+
+        assert winner["code"] == "print(1)"
+        assert len(finished) == 2
+
+    @pytest.mark.asyncio
+    async def test_raises_when_every_attempt_fails(self, monkeypatch):
+        scripted_attempts(monkeypatch, [(0.01, RuntimeError("first")), (0.02, RuntimeError("second"))])
+
+        with pytest.raises(RuntimeError, match="first"):
+            await _race_candidates("task", 0.7, 2)
+
+    @pytest.mark.asyncio
+    async def test_auto_fix_loop_reports_the_candidates_that_finished(self, monkeypatch):
+        calls = scripted_attempts(monkeypatch, [(0.01, False), (0.02, True), (5, True)])
+
+        result = await auto_fix_loop("task", max_iterations=1, candidates=3)
+        await asyncio.sleep(0)
+
+        assert result.success
+        assert result.clean_code == "print(1)"
+        assert result.candidates_used == 2
+        assert calls["cancelled"] == [2]
@@ -0,0 +1,63 @@
+import pytest
+import sandbox_server
+
+# Counts its runs in a module the zygote preloads, so leaked state would show up as a count above 1
+PROGRAM = """
+import json, sys
+json.runs = getattr(json, "runs", 0) + 1
+print(json.runs, input().upper(), *sys.argv[1:])
+"""
+
+
+@pytest.fixture
+def runners(monkeypatch) -> list:
+    """Every CaseRunner started during the test."""
+    started = []
+
+    class RecordingRunner(sandbox_server.CaseRunner):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            started.append(self)
+
+    monkeypatch.setattr(sandbox_server, "CaseRunner", RecordingRunner)
+    return started
+
+
+class TestCaseRunner:
+    @pytest.mark.asyncio
+    async def test_one_runner_forks_a_fresh_child_per_case(self, sandbox, runners):
+        cases = [
+            {"stdin": "a\n", "expected_stdout": "1 A"},
+            {"stdin": "b\n", "args": ["x", "y"], "expected_stdout": "1 B x y"},
+            {"stdin": "c\n", "expected_stdout": "2 C"},
+        ]
+
+        response = await sandbox.post("/execute_tests", json={"code": PROGRAM, "cases": cases})
+
+        data = response.json()
+        assert [r["stdout"].strip() for r in data["results"]] == ["1 A", "1 B x y", "1 C"]
+        assert [r["passed"] for r in data["results"]] == [True, True, False]
+        assert data["passed"] == 2 and data["failed"] == 1
+        assert len(runners) == 1
+        assert runners[0].process.killed  # Closed once the cases are done
+        runners[0].process.exit_code.result(timeout=5)
+
+    @pytest.mark.asyncio
+    async def test_a_case_timing_out_does_not_stop_the_rest(self, sandbox, runners):
+        code = "import time\nif input() == 'hang':\n    time.sleep(30)\nprint('done')"
+        cases = [{"stdin": "hang\n", "timeout_seconds": 0.5}, {"stdin": "go\n", "expected_stdout": "done"}]
+
+        response = await sandbox.post("/execute_tests", json={"code": code, "cases": cases})
+
+        first, second = response.json()["results"]
+        assert first["status"] == "timeout" and not first["passed"]
+        assert second["passed"]
+        assert len(runners) == 1
+
+    @pytest.mark.asyncio
+    async def test_syntax_error_fails_every_case(self, sandbox, runners):
+        response = await sandbox.post("/execute_tests", json={"code": "print(", "cases": [{}, {}]})
+
+        data = response.json()
+        assert data["failed"] == 2
+        assert all("SyntaxError" in r["stderr"] for r in data["results"])
@@ -0,0 +1,21 @@
+from codegen_server import Counter, Histogram
+
+
+class TestCodegenMetrics:
+    def test_counter_renders_large_totals_exactly(self):
+        counter = Counter("codegen_prompt_tokens_total", "Prompt tokens")
+        counter.inc(amount=1234567)
+
+        assert counter.render()[-1] == "codegen_prompt_tokens_total 1234567"
+
+    def test_histogram_renders_labelled_buckets(self):
+        histogram = Histogram("codegen_stage_seconds", "Stage latency", (0.1, 1.0), labels=("stage",))
+        histogram.observe(0.5, "precheck")
+
+        assert histogram.render()[2:] == [
+            'codegen_stage_seconds_bucket{stage="precheck",le="0.1"} 0',
+            'codegen_stage_seconds_bucket{stage="precheck",le="1.0"} 1',
+            'codegen_stage_seconds_bucket{stage="precheck",le="+Inf"} 1',
+            'codegen_stage_seconds_sum{stage="precheck"} 0.5',
+            'codegen_stage_seconds_count{stage="precheck"} 1',
+        ]
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import time
+import pytest
+from types import SimpleNamespace
+import codegen_server
+import sandbox_server
+
+
+async def call(app, path: str, body: dict, hang_up) -> list[dict]:
+    """POST `body` straight over ASGI; the client disconnects once `hang_up()` returns."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+        "headers": [(b"content-type", b"application/json")], "client": ("test", 1), "server": ("test", 80),
+    }
+    messages = [{"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await hang_up()
+        return {"type": "http.disconnect"}
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    await asyncio.wait_for(app(scope, receive, send), timeout=10)
+    return sent
+
+
+class TestCodegenDisconnect:
+    @pytest.mark.asyncio
+    async def test_hang_up_cancels_the_llm_call(self, monkeypatch):
+        started, cancelled = asyncio.Event(), asyncio.Event()
+
+        async def create(model, messages, **kwargs):
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        monkeypatch.setattr(codegen_server, "client", SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+        monkeypatch.setattr(codegen_server, "prompt_cache", codegen_server.PromptCache(0, 0))
+        monkeypatch.setitem(codegen_server.cancelled_on_disconnect, "generate", 0)
+
+        sent = await call(codegen_server.app, "/generate", {"prompt": "never answered"}, started.wait)
+
+        assert sent[0]["status"] == 499
+        assert cancelled.is_set()
+        assert codegen_server.cancelled_on_disconnect["generate"] == 1
+        assert codegen_server.in_flight.stats()["in_flight"] == 0
+
+    @pytest.mark.asyncio
+    async def test_hang_up_cancels_the_sandbox_call(self, mock_openai, monkeypatch):
+        started, cancelled = asyncio.Event(), asyncio.Event()
+
+        class SlowSandbox:
+            async def post(self, *args, **kwargs):
+                started.set()
+                try:
+                    await asyncio.sleep(60)
+                except asyncio.CancelledError:
+                    cancelled.set()
+                    raise
+
+        monkeypatch.setattr(codegen_server, "sandbox_client", SlowSandbox())
+        monkeypatch.setattr(codegen_server, "prompt_cache", codegen_server.PromptCache(0, 0))
+        monkeypatch.setitem(codegen_server.cancelled_on_disconnect, "generate", 0)
+
+        sent = await call(codegen_server.app, "/generate", {"prompt": "count the r's in strawberry"}, started.wait)
+
+        assert sent[0]["status"] == 499
+        assert cancelled.is_set()
+        assert codegen_server.cancelled_on_disconnect["generate"] == 1
+
+
+class TestSandboxDisconnect:
+    @pytest.mark.asyncio
+    async def test_hang_up_kills_the_running_child(self, sandbox):
+        engine = sandbox_server.engine
+        disconnects = sandbox_server.metrics.disconnects.values.get((), 0)
+
+        async def once_running():
+            while not engine.running:
+                await asyncio.sleep(0.01)
+
+        start = time.monotonic()
+        sent = await call(sandbox_server.app, "/execute", {"code": "import time\ntime.sleep(30)", "no_cache": True}, once_running)
+
+        assert sent[0]["status"] == 499
+        assert time.monotonic() - start < 10
+        assert engine.running == 0  # The slot is free again
+        assert sandbox_server.metrics.disconnects.values[()] == disconnects + 1
@@ -0,0 +1,30 @@
+import pytest
+from codegen_server import build_fix_prompt, estimate_tokens
+
+CODE = "\n".join(f"value_{i} = compute({i})  # step {i}" for i in range(1, 201))
+TRACEBACK = "Traceback (most recent call last):\n" + '  File "<string>", line 150, in <module>\n' * 40 + "NameError: name 'compute' is not defined"
+
+
+class TestBuildFixPrompt:
+    def test_short_prompts_are_left_alone(self):
+        prompt = build_fix_prompt("reverse 'abc'", "print(x)", "NameError: name 'x' is not defined", "NAME_ERROR")
+
+        assert prompt.startswith("reverse 'abc'\n")
+        assert "print(x)" in prompt and "NameError: name 'x' is not defined" in prompt
+
+    @pytest.mark.parametrize("budget", [300, 800, 1500])
+    def test_long_task_code_and_stderr_stay_within_budget(self, budget):
+        task = "Write a program that " + "really " * 1200 + "prints the answer."
+
+        prompt = build_fix_prompt(task, CODE, TRACEBACK, "NAME_ERROR", budget=budget)
+
+        assert estimate_tokens(prompt) <= budget
+        assert prompt.startswith("Write a program that")
+        assert "value_150 = compute(150)" in prompt  # the failing line survives
+        assert "NameError: name 'compute' is not defined" in prompt
+
+    def test_code_without_a_line_number_keeps_both_ends(self):
+        prompt = build_fix_prompt("task", CODE, "Execution timeout (10s)", "TIMEOUT", budget=300)
+
+        assert estimate_tokens(prompt) <= 300
+        assert "value_1 = compute(1)" in prompt and "value_200 = compute(200)" in prompt
@@ -0,0 +1,117 @@
+import asyncio
+import pytest
+import pytest_asyncio
+from fastapi import HTTPException
+import codegen_server
+from codegen_server import AutoFixResult, CodeRequest, JobManager
+
+
+@pytest_asyncio.fixture
+async def manager(monkeypatch):
+    """One worker, one queue place; each job's prompt names the gate it waits on before answering."""
+    gates: dict[str, asyncio.Event] = {}
+
+    async def fake_generation(request):
+        await gates.setdefault(request.prompt, asyncio.Event()).wait()
+        if request.prompt.startswith("fail"):
+            raise ValueError("model said no")
+        return AutoFixResult(final_answer=request.prompt, iterations=1, clean_code="", raw_response="", fixes_applied=[])
+
+    monkeypatch.setattr(codegen_server, "run_generation", fake_generation)
+    jobs = JobManager(workers=1, queue_size=1, ttl=3600, max_retained=100)
+    jobs.gates = gates
+    jobs.start()
+    yield jobs
+    await jobs.stop()
+
+
+def submit(jobs: JobManager, prompt: str):
+    return jobs.submit("generate", CodeRequest(prompt=prompt))
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def release(jobs: JobManager, prompt: str):
+    jobs.gates.setdefault(prompt, asyncio.Event()).set()
+
+
+class TestJobManager:
+    @pytest.mark.asyncio
+    async def test_job_runs_to_success_and_reports_its_events(self, manager):
+        job = submit(manager, "a")
+        release(manager, "a")
+
+        events = [event async for event in job.follow()]
+
+        assert job.status == "succeeded"
+        assert manager.get(job.id).result["final_answer"] == "a"
+        assert [e["status"] for e in events] == ["queued", "running", "succeeded"]
+
+    @pytest.mark.asyncio
+    async def test_failure_is_recorded(self, manager):
+        job = submit(manager, "fail")
+        release(manager, "fail")
+
+        [_ async for _ in job.follow()]
+
+        assert (job.status, job.error) == ("failed", "ValueError: model said no")
+
+    @pytest.mark.asyncio
+    async def test_full_queue_is_rejected_until_a_queued_job_is_cancelled(self, manager):
+        running = submit(manager, "slow")
+        await settle()
+        queued = submit(manager, "b")
+
+        with pytest.raises(HTTPException) as excinfo:
+            submit(manager, "c")
+        manager.cancel(queued.id)
+        replacement = submit(manager, "c")
+
+        assert excinfo.value.status_code == 429
+        assert (running.status, queued.status, replacement.status) == ("running", "cancelled", "queued")
+        release(manager, "slow")
+        release(manager, "c")
+        [_ async for _ in replacement.follow()]
+        assert replacement.status == "succeeded"
+
+    @pytest.mark.asyncio
+    async def test_cancel_running_job(self, manager):
+        job = submit(manager, "forever")
+        await settle()
+
+        manager.cancel(job.id)
+        [_ async for _ in job.follow()]
+
+        assert job.status == "cancelled"
+        assert manager.stats()["cancelled"] == 1
+
+    @pytest.mark.asyncio
+    async def test_reap_keeps_the_most_recently_finished(self, manager):
+        manager.max_retained = 1
+        old = submit(manager, "old")
+        release(manager, "old")
+        [_ async for _ in old.follow()]
+        newer = submit(manager, "newer")
+        release(manager, "newer")
+        [_ async for _ in newer.follow()]
+        old.finished = newer.finished + 1  # Created first, but ran longest
+
+        manager.reap()
+
+        assert list(manager.jobs) == [old.id]
+
+    @pytest.mark.asyncio
+    async def test_expired_jobs_are_forgotten(self, manager):
+        job = submit(manager, "a")
+        release(manager, "a")
+        [_ async for _ in job.follow()]
+        job.finished -= manager.ttl + 1
+
+        manager.reap()
+
+        with pytest.raises(HTTPException) as excinfo:
+            manager.get(job.id)
+        assert excinfo.value.status_code == 404
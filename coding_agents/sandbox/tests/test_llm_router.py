@@ -0,0 +1,99 @@
+import asyncio
+import httpx
+import openai
+import pytest
+from codegen_server import LLMRouter, affinity
+
+
+def completion(content: str) -> dict:
+    return {
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "qwen3-coder",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {
+            "prompt_tokens": 10,
+            "completion_tokens": 5,
+            "total_tokens": 15,
+            "prompt_tokens_details": {"cached_tokens": 8},
+        },
+    }
+
+
+class FakeBackends:
+    """OpenAI-compatible endpoints keyed by host; each answers with its own name unless told to fail."""
+
+    def __init__(self, *hosts, delay=0.0, status=None):
+        self.hosts = hosts
+        self.delay = delay
+        self.status = status or {}
+        self.calls = {host: 0 for host in hosts}
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        self.calls[host] += 1
+        await asyncio.sleep(self.delay)
+        if host in self.status:
+            return httpx.Response(self.status[host], json={"error": {"message": "boom"}})
+        return httpx.Response(200, json=completion(host))
+
+    def router(self, **options) -> LLMRouter:
+        http_client = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        return LLMRouter([f"http://{host}/v1" for host in self.hosts], "test-key", http_client=http_client, **options)
+
+
+async def ask(router: LLMRouter) -> str:
+    response = await router.chat.completions.create(model="qwen3-coder", messages=[{"role": "user", "content": "hi"}])
+    return response.choices[0].message.content
+
+
+class TestLLMRouter:
+    @pytest.mark.asyncio
+    async def test_spreads_concurrent_calls(self):
+        fakes = FakeBackends("a", "b", "c", delay=0.05)
+        router = fakes.router()
+
+        answers = await asyncio.gather(*(ask(router) for _ in range(6)))
+
+        assert sorted(answers) == ["a", "a", "b", "b", "c", "c"]
+        assert all(b["in_flight"] == 0 for b in router.stats()["backends"])
+        await router.close()
+
+    @pytest.mark.asyncio
+    async def test_fails_over_and_ejects(self):
+        fakes = FakeBackends("a", "b", status={"a": 503})
+        router = fakes.router(eject_after=2)
+
+        answers = [await ask(router) for _ in range(4)]
+
+        assert answers == ["b"] * 4
+        assert fakes.calls["a"] == 2  # Skipped once ejected
+        assert router.stats()["backends"][0]["healthy"] is False
+        await router.close()
+
+    @pytest.mark.asyncio
+    async def test_does_not_retry_bad_requests(self):
+        fakes = FakeBackends("a", "b", status={"a": 400, "b": 400})
+        router = fakes.router()
+
+        with pytest.raises(openai.BadRequestError):
+            await ask(router)
+
+        assert sum(fakes.calls.values()) == 1
+        await router.close()
+
+    @pytest.mark.asyncio
+    async def test_affinity_keeps_backend_and_counts_cached_tokens(self):
+        fakes = FakeBackends("a", "b")
+        router = fakes.router()
+
+        with affinity("project-1"):
+            first = await ask(router)
+            others = [await ask(router) for _ in range(3)]
+
+        assert others == [first] * 3
+        assert router.stats()["affinity_hits"] == 3
+        assert router.stats()["cached_prompt_tokens"] == 4 * 8
+        assert router.stats()["prefill_tokens"] == 4 * 2
+        await router.close()
@@ -0,0 +1,40 @@
+import pytest
+from sandbox_server import OutputBuffer
+
+
+def fill(data: bytes, chunk: int, head: int = 4, tail: int = 4) -> OutputBuffer:
+    buffer = OutputBuffer(head, tail)
+    for start in range(0, len(data), chunk):
+        buffer.append(data[start:start + chunk])
+    return buffer
+
+
+class TestOutputBuffer:
+    @pytest.mark.parametrize("chunk", [1, 3, 100])
+    def test_exactly_at_cap_is_kept_whole(self, chunk):
+        buffer = fill(b"abcdefgh", chunk)
+
+        assert not buffer.truncated
+        assert buffer.text() == "abcdefgh"
+
+    @pytest.mark.parametrize("chunk", [1, 3, 100])
+    def test_one_byte_over_cap_is_truncated(self, chunk):
+        buffer = fill(b"abcdefghi", chunk)
+
+        assert buffer.truncated
+        assert buffer.text() == "abcd\n... [1 bytes truncated] ...\nfghi"
+
+    @pytest.mark.parametrize("chunk", [1, 2, 5, 100])
+    def test_multibyte_characters_split_at_the_boundaries(self, chunk):
+        # "é" straddles the end of the head and "ñ" the start of the tail
+        buffer = fill("abcé12345ñxyz".encode(), chunk)
+
+        assert buffer.truncated
+        assert buffer.text() == "abc\n... [7 bytes truncated] ...\nxyz"
+
+    def test_memory_stays_bounded(self):
+        buffer = fill(b"x" * 100_000, 7, head=64, tail=64)
+
+        assert len(buffer.head) + buffer.tail_size == 128
+        assert buffer.total == 100_000
+        assert buffer.text().endswith("... [99872 bytes truncated] ...\n" + "x" * 64)
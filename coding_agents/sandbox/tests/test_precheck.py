@@ -0,0 +1,80 @@
+import sys
+import pytest
+from codegen_server import failure_message, needs_fix, precheck
+
+needs_pep695 = pytest.mark.skipif(sys.version_info < (3, 12), reason="PEP 695 syntax needs Python 3.12")
+
+
+class TestPrecheck:
+    @needs_pep695
+    @pytest.mark.parametrize("code", [
+        "def first[T](items: list[T]) -> T:\n    return items[0]\nprint(first([1, 2]))",
+        "class Box[T]:\n    def __init__(self, item: T):\n        self.item = item\nprint(Box(1).item)",
+        "type Pairs[K, V] = list[tuple[K, V]]\nprint(Pairs)",
+        "def call[**P, *Ts](f, *args: *Ts):\n    return f(*args)\nprint(call(max, 1, 2))",
+    ])
+    def test_type_parameters_are_defined(self, code):
+        assert precheck(code) is None
+
+    def test_dunder_class_in_methods_is_defined(self):
+        code = "class A:\n    def name(self):\n        return __class__.__name__\nprint(A().name(), __qualname__ if False else '')"
+        assert precheck(code) is None
+
+    @pytest.mark.parametrize("code", [
+        "import pprint\npprint.pp({'a': 1})",
+        "import logging, sys\nlogging.basicConfig(stream=sys.stdout, level=logging.INFO)\nlogging.info('hi')",
+        "result = 1 + 1",
+    ])
+    def test_output_is_left_to_the_sandbox(self, code):
+        assert precheck(code) is None
+
+    def test_reports_names_bound_nowhere(self):
+        error_type, message = precheck("value = 1\nprint(valeu)")
+
+        assert error_type == "NAME_ERROR"
+        assert "'valeu'" in message and "line 2" in message
+
+    @pytest.mark.parametrize("code", [
+        "def f():\n    return g()\nprint(1)",
+        "import sys\nif sys.version_info[0] < 3:\n    text_type = unicode\nprint(2 ** 70)",
+        "try:\n    number = long\nexcept NameError:\n    number = int\nprint(number(3))",
+        "handler = lambda: undefined_name\nprint(True or missing)",
+        "for item in []:\n    print(nope)\nprint(0)",
+    ])
+    def test_ignores_code_that_may_never_run(self, code):
+        assert precheck(code) is None
+
+    @pytest.mark.parametrize("code, line", [
+        ("class A:\n    size = undefined_size\nprint(A)", 2),
+        ("with open(__file__) as f:\n    print(f.read(), missing)", 2),
+        ("def f(x=missing):\n    return x\nprint(f())", 1),
+        ("if missing > 1:\n    print(1)", 1),
+    ])
+    def test_reports_names_read_unconditionally(self, code, line):
+        error_type, message = precheck(code)
+
+        assert error_type == "NAME_ERROR"
+        assert f"line {line}" in message
+
+    def test_reports_syntax_errors(self):
+        assert precheck("print(1")[0] == "SYNTAX_ERROR"
+
+    def test_reports_empty_replies(self):
+        assert precheck("   \n")[0] == "NO_OUTPUT"
+
+
+class TestNeedsFix:
+    def test_output_means_success(self):
+        assert needs_fix({"success": True, "stdout": "42\n", "stderr": ""}) == (False, "Success")
+
+    def test_clean_run_without_output_is_retried(self):
+        assert needs_fix({"success": True, "stdout": "  \n", "stderr": ""}) == (True, "NO_OUTPUT")
+
+    def test_unrecognised_failures_are_retried(self):
+        result = {"success": False, "stdout": "", "stderr": "ValueError: bad value", "exit_code": 1}
+
+        assert needs_fix(result) == (True, "OTHER_ERROR")
+
+    def test_silent_runs_get_a_message(self):
+        assert failure_message({"success": True, "stdout": "", "stderr": ""}, "NO_OUTPUT").startswith("NO_OUTPUT:")
+        assert failure_message({"success": False, "stderr": "", "exit_code": 3}, "OTHER_ERROR") == "OTHER_ERROR: exit code 3"
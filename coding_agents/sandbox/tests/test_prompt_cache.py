@@ -0,0 +1,83 @@
+import pytest
+import codegen_server
+from codegen_server import AutoFixResult, CodeRequest, PromptCache, run_generation
+
+SETTINGS = {"model": "qwen3-coder", "max_iterations": 3}
+RESULT = {"final_answer": "CBA", "success": True}
+
+
+@pytest.fixture
+def cache():
+    return PromptCache(max_entries=16, ttl=60)
+
+
+class TestPromptCache:
+    def test_exact_prompt_hits(self, cache):
+        cache.put("Reverse the string 'ABC'", SETTINGS, RESULT)
+
+        assert cache.get("Reverse the string 'ABC'", SETTINGS) == RESULT
+        assert cache.exact_hits == 1
+
+    def test_reflowed_whitespace_hits_the_normalised_key(self, cache):
+        cache.put("Reverse the string 'ABC'", SETTINGS, RESULT)
+
+        assert cache.get("  Reverse   the\nstring 'ABC'\n", SETTINGS) == RESULT
+        assert cache.normalized_hits == 1
+
+    @pytest.mark.parametrize("other", [
+        "reverse the string 'abc'",
+        "Reverse the string 'ABC'?",
+        "Reverse the string 'A  BC'",
+    ])
+    def test_prompts_that_differ_in_meaning_miss(self, cache, other):
+        cache.put("Reverse the string 'ABC'", SETTINGS, RESULT)
+
+        assert cache.get(other, SETTINGS) is None
+
+    def test_whitespace_inside_quotes_is_kept(self):
+        assert PromptCache.normalize("count  spaces in 'a  b'") == "count spaces in 'a  b'"
+
+    def test_settings_are_part_of_the_key(self, cache):
+        cache.put("Reverse the string 'ABC'", SETTINGS, RESULT)
+
+        assert cache.get("Reverse the string 'ABC'", {**SETTINGS, "max_iterations": 5}) is None
+
+    def test_max_entries_counts_results_not_keys(self):
+        cache = PromptCache(max_entries=2, ttl=60)
+        cache.put("first prompt", SETTINGS, RESULT)
+        cache.put("second prompt", SETTINGS, RESULT)
+
+        assert cache.get("first prompt", SETTINGS) == RESULT
+        assert cache.get("second  prompt", SETTINGS) == RESULT
+        assert cache.stats()["entries"] == 2
+
+    def test_disk_store_is_pruned_to_max_entries(self, tmp_path):
+        cache = PromptCache(max_entries=2, ttl=60, directory=str(tmp_path))
+        for prompt in ("one", "two", "three"):
+            cache.put(prompt, SETTINGS, RESULT)
+
+        assert len(list(tmp_path.glob("*.json"))) == 2
+        restarted = PromptCache(max_entries=2, ttl=60, directory=str(tmp_path))
+        assert restarted.get("three", SETTINGS) == RESULT
+        assert restarted.disk_hits == 1
+
+
+class TestCachedGeneration:
+    @pytest.mark.asyncio
+    async def test_hit_reports_no_costs(self, monkeypatch):
+        async def fake_loop(prompt, max_iterations, candidates, fix_mode):
+            return AutoFixResult(
+                final_answer="6", iterations=1, clean_code="print(6)", raw_response="print(6)", fixes_applied=[],
+                success=True, prompt_tokens=[120], cached_prompt_tokens=[80], timings=[{"llm_generate": 38.0}],
+                candidates_used=3, sandbox_calls_saved=1,
+            )
+
+        monkeypatch.setattr(codegen_server, "auto_fix_loop", fake_loop)
+        monkeypatch.setattr(codegen_server, "prompt_cache", PromptCache(16, 60))
+        await run_generation(CodeRequest(prompt="add 1 2 3"))
+
+        hit = await run_generation(CodeRequest(prompt="add 1 2 3"))
+
+        assert hit.cached and hit.final_answer == "6"
+        assert (hit.timings, hit.prompt_tokens, hit.cached_prompt_tokens) == ([], [], [])
+        assert (hit.candidates_used, hit.sandbox_calls_saved) == (0, 0)
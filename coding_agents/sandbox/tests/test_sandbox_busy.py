@@ -0,0 +1,63 @@
+import httpx
+import inspect
+import pytest
+from fastapi import HTTPException
+import codegen_server
+from codegen_server import _attempt, _execute_in_sandbox
+
+
+def busy() -> httpx.Response:
+    return httpx.Response(
+        429,
+        headers={"Retry-After": "0"},
+        json={"success": False, "stdout": "", "stderr": "busy", "exit_code": 429, "retry_after": 0},
+    )
+
+
+def sandbox(monkeypatch, responses: list[httpx.Response]) -> list[httpx.Request]:
+    """Serve the given responses to sandbox calls in order; returns the requests seen."""
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request)
+        return responses[len(seen) - 1]
+
+    client = httpx.AsyncClient(base_url="http://sandbox", transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(codegen_server, "sandbox_client", client)
+    return seen
+
+
+class TestSandboxBusy:
+    @pytest.mark.asyncio
+    async def test_retries_after_429(self, monkeypatch):
+        seen = sandbox(monkeypatch, [busy(), busy(), httpx.Response(200, json={"success": True, "stdout": "42", "stderr": ""})])
+
+        result = await _execute_in_sandbox("print(42)")
+
+        assert result["stdout"] == "42"
+        assert len(seen) == 3
+
+    @pytest.mark.asyncio
+    async def test_gives_up_with_503(self, monkeypatch):
+        monkeypatch.setattr(codegen_server, "SANDBOX_BUSY_RETRIES", 1)
+        seen = sandbox(monkeypatch, [busy(), busy()])
+
+        with pytest.raises(HTTPException) as excinfo:
+            await _execute_in_sandbox("print(42)")
+
+        assert excinfo.value.status_code == 503
+        assert len(seen) == 2
+
+    @pytest.mark.asyncio
+    async def test_busy_sandbox_is_never_judged(self, monkeypatch):
+        async def generate(prompt: str, temperature: float) -> tuple[str, int, int]:
+            return "print(42)", 10, 0
+
+        # Calls that would not fit the real function must not pass against the fake either
+        assert inspect.signature(generate) == inspect.signature(codegen_server._generate)
+        monkeypatch.setattr(codegen_server, "SANDBOX_BUSY_RETRIES", 0)
+        monkeypatch.setattr(codegen_server, "_generate", generate)
+        sandbox(monkeypatch, [busy()])
+
+        with pytest.raises(HTTPException):
+            await _attempt("print 42", 0.7)
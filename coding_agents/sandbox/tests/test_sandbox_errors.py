@@ -1,3 +1,6 @@
+import pytest
+from httpx import AsyncClient
+
 class TestSandboxEdgeCases:
     @pytest.mark.asyncio
     async def test_name_error(self, test_client: AsyncClient):
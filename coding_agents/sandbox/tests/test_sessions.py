@@ -0,0 +1,104 @@
+import asyncio
+import os
+import socket
+import pytest
+import sandbox_server
+import sandbox_zygote
+from sandbox_server import ControlChannel, Execution
+
+
+async def new_session(sandbox) -> str:
+    response = await sandbox.post("/sessions", json={})
+    assert response.status_code == 200
+    return response.json()["session_id"]
+
+
+class TestSessions:
+    @pytest.mark.asyncio
+    async def test_cells_share_globals_until_closed(self, sandbox):
+        session_id = await new_session(sandbox)
+
+        await sandbox.post(f"/sessions/{session_id}/execute", json={"code": "x = 21"})
+        second = (await sandbox.post(f"/sessions/{session_id}/execute", json={"code": "print(x * 2)"})).json()
+        closed = await sandbox.delete(f"/sessions/{session_id}")
+        after = await sandbox.post(f"/sessions/{session_id}/execute", json={"code": "print(x)"})
+
+        assert (second["stdout"], second["cell"], second["session_closed"]) == ("42", 2, False)
+        assert closed.json() == {"session_id": session_id, "closed": True}
+        assert after.status_code == 404
+        assert (await sandbox.delete(f"/sessions/{session_id}")).status_code == 404
+
+    @pytest.mark.asyncio
+    async def test_exit_ends_the_session(self, sandbox):
+        session_id = await new_session(sandbox)
+
+        result = (await sandbox.post(f"/sessions/{session_id}/execute", json={"code": "raise SystemExit(3)"})).json()
+
+        assert (result["exit_code"], result["session_closed"]) == (3, True)
+        assert session_id not in sandbox_server.sessions.sessions
+
+    @pytest.mark.asyncio
+    async def test_cell_queued_behind_the_last_one_gets_404(self, sandbox):
+        session_id = await new_session(sandbox)
+        errors_before = sandbox_server.metrics.executions.values.get(("error",), 0)
+
+        first, second = await asyncio.gather(
+            sandbox.post(f"/sessions/{session_id}/execute", json={"code": "import time\ntime.sleep(0.2)\nraise SystemExit"}),
+            sandbox.post(f"/sessions/{session_id}/execute", json={"code": "print(1)"}),
+        )
+
+        assert first.json()["session_closed"] is True
+        assert second.status_code == 404
+        assert sandbox_server.metrics.executions.values.get(("error",), 0) == errors_before
+
+
+class TestControlProtocol:
+    """The framed-request / JSON-event protocol between ControlChannel and the zygote side."""
+
+    @pytest.fixture
+    def channel(self):
+        ours, theirs = socket.socketpair()
+        channel = ControlChannel(ours)
+        yield channel, theirs
+        channel.close()
+        theirs.close()
+
+    def test_request_carries_fds_and_events_resolve_the_execution(self, channel):
+        channel, peer = channel
+        execution = Execution(7)
+        read_end, write_end = os.pipe()
+
+        channel.spawn(execution, {"code": "print(1)"}, [write_end])
+        request, fds = sandbox_zygote.recv_request(peer)
+        sandbox_zygote.send_event(peer, {"id": 7, "pid": 4242})
+        sandbox_zygote.send_event(peer, {"id": 7, "exit_code": 0, "rusage": {"user_seconds": 0.5}})
+
+        assert request == {"id": 7, "code": "print(1)"}
+        assert len(fds) == 1
+        assert execution.pid.result(timeout=5) == 4242
+        assert execution.exit_code.result(timeout=5) == 0
+        assert execution.rusage == {"user_seconds": 0.5}
+        for fd in (read_end, write_end, *fds):
+            os.close(fd)
+
+    def test_error_event_fails_the_execution(self, channel):
+        channel, peer = channel
+        execution = Execution(1)
+
+        channel.spawn(execution, {}, [])
+        sandbox_zygote.recv_request(peer)
+        sandbox_zygote.send_event(peer, {"id": 1, "error": "fork failed"})
+
+        with pytest.raises(RuntimeError, match="fork failed"):
+            execution.exit_code.result(timeout=5)
+
+    def test_peer_hang_up_fails_pending_executions(self, channel):
+        # The request is left unread, so the close resets the connection rather than ending it cleanly
+        channel, peer = channel
+        execution = Execution(1)
+
+        channel.spawn(execution, {}, [])
+        peer.close()
+
+        with pytest.raises(RuntimeError, match="exited"):
+            execution.pid.result(timeout=5)
@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+import codegen_server
+from codegen_server import AutoFixResult, CodeRequest, PromptCache, run_generation
+
+
+@pytest.fixture
+def loops(monkeypatch) -> list[tuple]:
+    """Replace the auto-fix loop with a slow fake and record each real run."""
+    runs = []
+
+    async def fake_loop(prompt, max_iterations, candidates, fix_mode):
+        runs.append((prompt, candidates, fix_mode))
+        await asyncio.sleep(0.05)
+        return AutoFixResult(final_answer="", iterations=1, clean_code="print(1)", raw_response="", fixes_applied=[])
+
+    monkeypatch.setattr(codegen_server, "auto_fix_loop", fake_loop)
+    monkeypatch.setattr(codegen_server, "prompt_cache", PromptCache(0, 0))
+    monkeypatch.setattr(codegen_server, "in_flight", codegen_server.SingleFlight())
+    return runs
+
+
+class TestSingleFlight:
+    @pytest.mark.asyncio
+    async def test_identical_requests_share_one_run(self, loops):
+        results = await asyncio.gather(*(run_generation(CodeRequest(prompt="add two numbers")) for _ in range(3)))
+
+        assert len(loops) == 1
+        assert sorted(r.coalesced for r in results) == [False, True, True]
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(
+        "other",
+        [
+            {"prompt": "Add two numbers"},
+            {"prompt": "add two numbers", "candidates": 3},
+            {"prompt": "add two numbers", "fix_mode": "diff"},
+            {"prompt": "add two numbers", "max_iterations": 1},
+        ],
+    )
+    async def test_requests_that_differ_run_separately(self, loops, other):
+        results = await asyncio.gather(
+            run_generation(CodeRequest(prompt="add two numbers", fix_mode="full")),
+            run_generation(CodeRequest(**{"fix_mode": "full", **other})),
+        )
+
+        assert len(loops) == 2
+        assert not any(r.coalesced for r in results)
+
+    @pytest.mark.asyncio
+    async def test_no_cache_requests_never_share(self, loops):
+        await asyncio.gather(*(run_generation(CodeRequest(prompt="add two numbers", no_cache=True)) for _ in range(2)))
+
+        assert len(loops) == 2
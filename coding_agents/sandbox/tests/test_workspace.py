@@ -0,0 +1,114 @@
+import io
+import os
+import stat
+import tarfile
+import zipfile
+import pytest
+import sandbox_server
+from sandbox_server import Workspace, WorkspaceError
+
+
+def tar_of(*members: tuple[tarfile.TarInfo, bytes]) -> bytes:
+    blob = io.BytesIO()
+    with tarfile.open(fileobj=blob, mode="w:gz") as archive:
+        for info, data in members:
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return blob.getvalue()
+
+
+def tar_link(name: str, target: str, kind: bytes) -> tuple[tarfile.TarInfo, bytes]:
+    info = tarfile.TarInfo(name)
+    info.type, info.linkname = kind, target
+    return info, b""
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    ws = Workspace(str(tmp_path), max_bytes=1024, max_files=10)
+    yield ws
+    ws.close()
+
+
+class TestWorkspacePaths:
+    @pytest.mark.parametrize("name", ["", ".", "/etc/passwd", "\\evil.py", "..", "../x.py", "a/../../x.py", "a\\..\\..\\x.py", "a/./../b/../../x.py"])
+    def test_refuses_paths_outside_the_workspace(self, name):
+        with pytest.raises(WorkspaceError):
+            Workspace.relative(name)
+
+    @pytest.mark.parametrize("name, expected", [("main.py", "main.py"), ("./pkg//mod.py", "pkg/mod.py"), ("pkg\\sub\\mod.py", "pkg/sub/mod.py")])
+    def test_normalises_relative_paths(self, name, expected):
+        assert Workspace.relative(name) == expected
+
+    @pytest.mark.parametrize("first, second", [("a.py", "a.py"), ("a.py", "a.py/x/y.py"), ("pkg/mod.py", "pkg")])
+    def test_conflicting_files_are_a_workspace_error(self, workspace, first, second):
+        workspace.add(first, b"x = 1")
+
+        with pytest.raises(WorkspaceError, match="Duplicate or conflicting path"):
+            workspace.add(second, b"x = 2")
+
+    def test_close_removes_everything(self, workspace):
+        workspace.add("pkg/mod.py", b"x = 1")
+        workspace.close()
+
+        assert not os.path.exists(workspace.path)
+
+
+class TestWorkspaceArchives:
+    @pytest.mark.parametrize("kind", [tarfile.SYMTYPE, tarfile.LNKTYPE])
+    def test_refuses_tar_links(self, workspace, kind):
+        blob = tar_of(tar_link("passwd", "/etc/passwd", kind))
+
+        with pytest.raises(WorkspaceError, match="link"):
+            workspace.add_archive(blob)
+        assert os.listdir(workspace.path) == []
+
+    def test_refuses_zip_symlinks(self, workspace):
+        blob = io.BytesIO()
+        with zipfile.ZipFile(blob, "w") as archive:
+            info = zipfile.ZipInfo("passwd")
+            info.external_attr = (stat.S_IFLNK | 0o777) << 16
+            archive.writestr(info, "/etc/passwd")
+
+        with pytest.raises(WorkspaceError, match="link"):
+            workspace.add_archive(blob.getvalue())
+
+    def test_refuses_escaping_zip_entries(self, workspace):
+        blob = io.BytesIO()
+        with zipfile.ZipFile(blob, "w") as archive:
+            archive.writestr("../escape.py", "x = 1")
+
+        with pytest.raises(WorkspaceError, match="Invalid path"):
+            workspace.add_archive(blob.getvalue())
+
+    def test_duplicate_archive_entries_do_not_leak_the_workspace_path(self, workspace):
+        blob = tar_of((tarfile.TarInfo("a.py"), b"x = 1"), (tarfile.TarInfo("a.py/b.py"), b"x = 2"))
+
+        with pytest.raises(WorkspaceError) as excinfo:
+            workspace.add_archive(blob)
+        assert workspace.path not in str(excinfo.value)
+
+
+class TestProjectRuns:
+    @pytest.mark.asyncio
+    async def test_entry_point_imports_its_siblings(self, sandbox):
+        files = [
+            {"path": "app/main.py", "code": "from util import add\nprint(add(1, 2))"},
+            {"path": "app/util.py", "code": "def add(a, b):\n    return a + b"},
+        ]
+
+        response = await sandbox.post("/execute_project", json={"files": files, "entry_point": "app/main.py"})
+
+        assert response.json()["stdout"] == "3", response.json()["stderr"]
+
+    @pytest.mark.asyncio
+    async def test_run_that_outgrows_its_workspace_is_killed(self, sandbox, monkeypatch):
+        monkeypatch.setattr(sandbox_server, "MAX_WORKSPACE_BYTES", 256 * 1024)
+        code = "import time\nfor i in range(8):\n    open(f'out{i}.bin', 'wb').write(bytes(100 * 1024))\ntime.sleep(5)"
+
+        response = await sandbox.post("/execute_project", json={"files": [{"path": "main.py", "code": code}], "entry_point": "main.py"})
+        result = response.json()
+
+        assert result["success"] is False
+        assert "Workspace limit exceeded" in result["stderr"]
+        assert result["usage"]["wall_ms"] < 4000
@@ -0,0 +1,63 @@
+import pytest
+
+
+async def execute(sandbox, code: str, **limits) -> dict:
+    body = {"code": code, "no_cache": True}
+    if limits:
+        body["limits"] = limits
+    response = await sandbox.post("/execute", json=body)
+    assert response.status_code == 200
+    return response.json()
+
+
+class TestZygoteFork:
+    @pytest.mark.asyncio
+    async def test_child_starts_with_preloaded_modules(self, sandbox):
+        result = await execute(sandbox, "import sys\nprint('json' in sys.modules, repr(sys.path[0]))")
+
+        assert result["success"]
+        assert result["stdout"].strip() == "True ''"
+
+    @pytest.mark.asyncio
+    async def test_children_do_not_share_state(self, sandbox):
+        code = "import json\nprint(getattr(json, 'runs', 0))\njson.runs = 1"
+
+        first = await execute(sandbox, code)
+        second = await execute(sandbox, code)
+
+        assert first["stdout"].strip() == second["stdout"].strip() == "0"
+
+    @pytest.mark.asyncio
+    async def test_usage_comes_from_the_child(self, sandbox):
+        result = await execute(sandbox, "x = sum(range(3_000_000))\nprint(x)")
+
+        usage = result["usage"]
+        assert usage["cpu_user_ms"] + usage["cpu_sys_ms"] > 0
+        assert usage["max_rss_kb"] > 0
+        assert usage["wall_ms"] > 0
+
+
+class TestChildLimits:
+    @pytest.mark.asyncio
+    async def test_memory_limit(self, sandbox):
+        result = await execute(sandbox, "b = bytearray(512 * 1024 * 1024)\nprint('allocated')", memory_mb=64)
+
+        assert not result["success"]
+        assert "allocated" not in result["stdout"]
+        assert "MemoryError" in result["stderr"]
+
+    @pytest.mark.asyncio
+    async def test_file_size_limit(self, sandbox):
+        code = "import tempfile\nwith tempfile.TemporaryFile() as f:\n    f.write(b'x' * (2 * 1024 * 1024))\n    f.flush()\nprint('written')"
+
+        result = await execute(sandbox, code, file_size_mb=1)
+
+        assert not result["success"]
+        assert "written" not in result["stdout"]
+
+    @pytest.mark.asyncio
+    async def test_timeout_kills_the_child(self, sandbox):
+        result = await execute(sandbox, "while True:\n    pass", timeout_seconds=0.5)
+
+        assert not result["success"]
+        assert result["usage"]["wall_ms"] < 5000